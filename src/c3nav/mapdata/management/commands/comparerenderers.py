@@ -0,0 +1,84 @@
+import random
+import time
+from io import BytesIO
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.translation import ugettext_lazy as _
+from PIL import Image
+
+from c3nav.mapdata.models import Level
+from c3nav.mapdata.render.renderer import MapRenderer
+from c3nav.mapdata.utils.cache import CachePackage
+from c3nav.mapdata.utils.tiles import get_tile_bounds
+
+
+class Command(BaseCommand):
+    help = 'render random tiles with the svg and the cairo engine and compare the results pixel by pixel'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', default=20, type=int,
+                            help=_('number of tiles to compare (default: 20)'))
+        parser.add_argument('--zoom', default=None, type=int,
+                            help=_('zoom level of the tiles, between -2 and 5 (default: random)'))
+        parser.add_argument('--seed', default=None, type=int,
+                            help=_('random seed'))
+        parser.add_argument('--tolerance', default=32, type=int,
+                            help=_('maximum difference of a color channel that does not count as a different pixel '
+                                   '(default: 32)'))
+        parser.add_argument('--threshold', default=0.01, type=float,
+                            help=_('maximum share of different pixels per tile (default: 0.01)'))
+
+    @staticmethod
+    def render(engine_cls, level, zoom, x, y):
+        minx, miny, maxx, maxy = get_tile_bounds(zoom, x, y)
+        renderer = MapRenderer(level, minx, miny, maxx, maxy, scale=2 ** zoom)
+        start = time.perf_counter()
+        data = renderer.render(engine_cls).render()
+        duration = time.perf_counter() - start
+        image = np.array(Image.open(BytesIO(data)).convert('RGB'), dtype=np.int16)
+        return image, duration
+
+    def handle(self, *args, **options):
+        from c3nav.mapdata.render.engines.cairo import CairoEngine
+        from c3nav.mapdata.render.engines.svg import SVGEngine
+
+        if options['zoom'] is not None and not (-2 <= options['zoom'] <= 5):
+            raise CommandError(_('Zoom has to be between -2 and 5'))
+
+        rand = random.Random(options['seed'])
+        cache_package = CachePackage.open()
+        bounds_minx, bounds_miny, bounds_maxx, bounds_maxy = cache_package.bounds
+        levels = tuple(Level.objects.values_list('pk', flat=True))
+
+        failed = 0
+        svg_duration = 0
+        cairo_duration = 0
+        for i in range(options['count']):
+            level = rand.choice(levels)
+            zoom = rand.randint(-2, 5) if options['zoom'] is None else options['zoom']
+            size = 256 / 2 ** zoom
+            x = int(rand.uniform(bounds_minx, bounds_maxx) // size)
+            y = int(-rand.uniform(bounds_miny, bounds_maxy) // size)
+
+            svg_image, duration = self.render(SVGEngine, level, zoom, x, y)
+            svg_duration += duration
+            cairo_image, duration = self.render(CairoEngine, level, zoom, x, y)
+            cairo_duration += duration
+
+            if svg_image.shape != cairo_image.shape:
+                print('level %d, tile %d/%d/%d: size differs, %s vs %s' %
+                      (level, zoom, x, y, svg_image.shape, cairo_image.shape))
+                failed += 1
+                continue
+
+            different = (np.abs(svg_image - cairo_image).max(axis=2) > options['tolerance']).mean()
+            print('level %d, tile %d/%d/%d: %.2f%% different pixels' % (level, zoom, x, y, different * 100))
+            if different > options['threshold']:
+                failed += 1
+
+        print('svg: %.1f ms/tile, cairo: %.1f ms/tile' % (svg_duration / options['count'] * 1000,
+                                                          cairo_duration / options['count'] * 1000))
+
+        if failed:
+            raise CommandError(_('%d of %d tiles differ too much.') % (failed, options['count']))
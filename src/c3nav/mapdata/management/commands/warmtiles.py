@@ -0,0 +1,62 @@
+import argparse
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils.translation import ugettext_lazy as _
+
+from c3nav.mapdata.models import MapUpdate
+from c3nav.mapdata.render.tiles import warm_tiles
+
+
+class Command(BaseCommand):
+    help = 'pre-render changed tiles into the tile cache'
+
+    @staticmethod
+    def zooms_value(value):
+        try:
+            zooms = tuple(int(i) for i in value.split(',') if i)
+        except ValueError:
+            raise argparse.ArgumentTypeError(_('Invalid zoom'))
+
+        if not all(-2 <= zoom <= 5 for zoom in zooms):
+            raise argparse.ArgumentTypeError(_('Zoom has to be between -2 and 5'))
+
+        return zooms
+
+    @staticmethod
+    def permissions_value(value):
+        try:
+            return frozenset(int(i) for i in value.split(',') if i) - set([0])
+        except ValueError:
+            raise argparse.ArgumentTypeError(_('Invalid permissions'))
+
+    @staticmethod
+    def update_value(value):
+        try:
+            return MapUpdate.objects.get(pk=int(value)).to_tuple
+        except (ValueError, MapUpdate.DoesNotExist):
+            raise argparse.ArgumentTypeError(_('Unknown map update: %s') % value)
+
+    def add_arguments(self, parser):
+        parser.add_argument('--zooms', default=settings.TILE_WARM_ZOOMS, type=self.zooms_value,
+                            help=_('zoom levels to render, e.g. 3,4,5 (default from settings)'))
+        parser.add_argument('--permissions', nargs='+', default=settings.TILE_WARM_PERMISSIONS,
+                            type=self.permissions_value,
+                            help=_('permission sets to render, e.g. 0 2,3 (default from settings)'))
+        parser.add_argument('--since', type=self.update_value,
+                            help=_('only render tiles that changed after this map update (default: all tiles)'))
+        parser.add_argument('--processes', type=int, default=None,
+                            help=_('number of processes to render with (default: number of CPUs)'))
+
+    def handle(self, *args, **options):
+        if not settings.CACHE_TILES:
+            print(_('Tile caching is disabled, nothing to do.'))
+            return
+
+        if not options['zooms']:
+            print(_('No zoom levels to render given.'))
+            return
+
+        rendered = warm_tiles(options['zooms'], options['permissions'],
+                              since_update=options['since'], processes=options['processes'])
+        print(_('%d tiles rendered.') % rendered)
@@ -0,0 +1,150 @@
+import math
+from itertools import chain
+from typing import Optional
+
+import cairocffi
+import numpy as np
+from scipy.ndimage import gaussian_filter
+from shapely.affinity import translate
+from shapely.geometry import LineString, Polygon
+
+from c3nav.mapdata.render.engines.base import FillAttribs, RenderEngine, StrokeAttribs
+
+
+class CairoEngine(RenderEngine):
+    """
+    draws the geometries directly onto a cairo image surface, without generating svg or calling other programs.
+    the output looks like the SVGEngine's, including shadows.
+    """
+    filetype = 'png'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # draw with buffer, so shadows get blurred correctly at the edges, it gets cropped in render()
+        self.surface = cairocffi.ImageSurface(cairocffi.FORMAT_ARGB32, self.buffered_width, self.buffered_height)
+        self.context = cairocffi.Context(self.surface)
+        self.context.set_source_rgb(*self.background_rgb)
+        self.context.paint()
+        self.context.set_fill_rule(cairocffi.FILL_RULE_WINDING)  # svg default (nonzero)
+        self.context.set_miter_limit(4)  # svg default
+
+        # for fast numpy operations, from coordinates to pixels on the buffered surface
+        self.np_scale = np.array((self.scale, -self.scale))
+        self.np_offset = np.array((-self.minx * self.scale + self.buffer, self.maxy * self.scale + self.buffer))
+
+    def render(self, filename=None):
+        surface = cairocffi.ImageSurface(cairocffi.FORMAT_RGB24, self.width, self.height)
+        context = cairocffi.Context(surface)
+        context.set_source_surface(self.surface, -self.buffer, -self.buffer)
+        context.paint()
+        return surface.write_to_png()
+
+    def _get_geoms(self, geom):
+        # get all polygons and linestrings, in the order the svg engine would draw them
+        if isinstance(geom, (Polygon, LineString)):
+            return () if geom.is_empty else (geom, )
+        try:
+            geoms = geom.geoms
+        except AttributeError:
+            return ()
+        return tuple(chain(*(self._get_geoms(g) for g in geoms)))
+
+    def _add_path(self, context, coords, close):
+        coords = np.array(coords)[:, :2] * self.np_scale + self.np_offset
+        context.move_to(*coords[0])
+        for x, y in coords[1:]:
+            context.line_to(x, y)
+        if close:
+            context.close_path()
+
+    def _add_geom_path(self, context, geom):
+        if isinstance(geom, Polygon):
+            for ring in chain((geom.exterior, ), geom.interiors):
+                self._add_path(context, ring.coords, close=True)
+        else:
+            self._add_path(context, geom.coords, close=False)
+
+    def add_shadow(self, geometry, elevation):
+        # add a shadow for the given geometry with the given elevation, blurred like the svg filter
+        elevation = float(min(elevation, 2))
+        blur_radius = elevation / 3 * 0.25
+
+        shadow_geom = translate(geometry.buffer(blur_radius),
+                                xoff=(elevation / 3 * 0.12), yoff=-(elevation / 3 * 0.12))
+
+        # only draw and blur the area around the shadow, the gaussian filter does not reach further than 4 sigma
+        sigma = blur_radius * self.scale
+        padding = int(math.ceil(sigma * 4)) + 1
+        if shadow_geom.is_empty:
+            return
+        minx, miny, maxx, maxy = shadow_geom.bounds
+        left, top = (np.floor(np.array((minx, maxy)) * self.np_scale + self.np_offset) - padding).tolist()
+        right, bottom = (np.ceil(np.array((maxx, miny)) * self.np_scale + self.np_offset) + padding).tolist()
+        left, top = max(int(left), 0), max(int(top), 0)
+        right, bottom = min(int(right), self.buffered_width), min(int(bottom), self.buffered_height)
+        if right <= left or bottom <= top:
+            return
+        width, height = right - left, bottom - top
+
+        mask = cairocffi.ImageSurface(cairocffi.FORMAT_A8, width, height)
+        context = cairocffi.Context(mask)
+        context.set_fill_rule(cairocffi.FILL_RULE_WINDING)
+        context.translate(-left, -top)
+        for geom in self._get_geoms(shadow_geom):
+            if isinstance(geom, Polygon):
+                self._add_geom_path(context, geom)
+                context.fill()
+        mask.flush()
+
+        data = np.ndarray(shape=(height, mask.get_stride()), dtype=np.uint8, buffer=mask.get_data())
+        blurred = gaussian_filter(data[:, :width].astype(np.float32), sigma)
+        data[:, :width] = blurred.round().clip(0, 255).astype(np.uint8)
+        mask.mark_dirty()
+
+        self.context.set_source_rgba(0, 0, 0, 0.2)
+        self.context.mask_surface(mask, left, top)
+
+    def darken(self, area):
+        if area:
+            self.add_geometry(geometry=area, fill=FillAttribs('#000000', 0.1), category='darken')
+
+    def _get_rgba(self, color, opacity):
+        # like the svg engine, which omits the opacity attribute if it is falsy
+        red, green, blue, alpha = self.color_to_rgb(color)
+        return red, green, blue, alpha * opacity if opacity else alpha
+
+    def _add_geometry(self, geometry, fill: Optional[FillAttribs], stroke: Optional[StrokeAttribs],
+                      altitude=None, height=None, shape_cache_key=None, **kwargs):
+        geometry = self.buffered_bbox.intersection(geometry.geom if hasattr(geometry, 'geom') else geometry)
+
+        if geometry.is_empty:
+            return
+
+        if altitude is not None and stroke is None:
+            stroke = StrokeAttribs('rgba(0, 0, 0, 0.15)', 0.05, min_px=0.2)
+
+        fill_rgba = None if fill is None else self._get_rgba(fill.color, fill.opacity)
+
+        stroke_rgba = None
+        if stroke:
+            stroke_rgba = self._get_rgba(stroke.color, stroke.opacity)
+            width = stroke.width * self.scale
+            if stroke.min_px:
+                width = max(width, stroke.min_px)
+            self.context.set_line_width(width)
+
+        if height is not None:
+            self.add_shadow(geometry, height)
+
+        # fill and stroke every shape on its own, just like the svg engine's <path> elements
+        context = self.context
+        for geom in self._get_geoms(geometry):
+            self._add_geom_path(context, geom)
+            if fill_rgba is not None:
+                context.set_source_rgba(*fill_rgba)
+                context.fill_preserve()
+            if stroke_rgba is not None:
+                context.set_source_rgba(*stroke_rgba)
+                context.stroke_preserve()
+            context.new_path()
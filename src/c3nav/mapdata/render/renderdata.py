@@ -1,22 +1,25 @@
+import math
 import operator
 import os
 import pickle
 import threading
 from collections import deque
+from copy import copy
 from itertools import chain
 
 import numpy as np
 from django.conf import settings
 from scipy.interpolate import NearestNDInterpolator
 from shapely import prepared
-from shapely.geometry import GeometryCollection
+from shapely.geometry import GeometryCollection, box
 from shapely.ops import unary_union
 
 from c3nav.mapdata.models import Level, MapUpdate, Source
-from c3nav.mapdata.render.geometry import AltitudeAreaGeometries, LevelGeometries
+from c3nav.mapdata.render.geometry import AltitudeAreaGeometries, HybridGeometry, LevelGeometries
 from c3nav.mapdata.utils.cache import AccessRestrictionAffected, MapHistory
 from c3nav.mapdata.utils.cache.package import CachePackage
 from c3nav.mapdata.utils.geometry import get_rings
+from c3nav.mapdata.utils.index import Index
 
 empty_geometry_collection = GeometryCollection()
 
@@ -39,11 +42,19 @@ class LevelRenderData:
     Renderdata for a level to display.
     This contains multiple LevelGeometries instances because you might to look through holes onto lower levels.
     """
+    # geometries are split into chunks of this size for the spatial index, overlapping by the margin
+    index_chunk_size = 64
+    index_chunk_margin = 1
+    # bigger areas show most of the level anyway, so they are rendered without using the index
+    index_max_area_size = 256
+
     def __init__(self):
         self.levels = []
         self.base_altitude = None
         self.lowest_important_level = None
         self.darken_area = None
+        self.index_pieces = None
+        self._index = None
 
     @staticmethod
     def rebuild():
@@ -260,6 +271,7 @@ class LevelRenderData:
 
             package.add_level(level.pk, map_history, access_restriction_affected)
 
+            render_data.build_index()
             render_data.save(level.pk)
 
         package.save_all()
@@ -295,3 +307,148 @@ class LevelRenderData:
 
     def save(self, pk):
         return pickle.dump(self, open(self._level_filename(pk), 'wb'))
+
+    def __getstate__(self):
+        # the spatial index can't be pickled, it is created again from the index pieces when needed
+        state = self.__dict__.copy()
+        state.pop('_index', None)
+        return state
+
+    def _get_index_chunks(self, geometry):
+        if geometry.is_empty:
+            return ()
+
+        minx, miny, maxx, maxy = geometry.bounds
+        size = self.index_chunk_size
+        if maxx - minx <= size and maxy - miny <= size:
+            return (geometry, )
+
+        # chunks overlap, so their edges disappear when they are put together again
+        margin = self.index_chunk_margin
+        geometry_prep = prepared.prep(geometry)
+        chunks = deque()
+        for x in range(int(math.floor(minx / size)), int(math.ceil(maxx / size))):
+            for y in range(int(math.floor(miny / size)), int(math.ceil(maxy / size))):
+                cell = box(x * size - margin, y * size - margin, (x + 1) * size + margin, (y + 1) * size + margin)
+                if not geometry_prep.intersects(cell):
+                    continue
+                chunk = geometry.intersection(cell)
+                if not chunk.is_empty:
+                    chunks.append(chunk)
+        return tuple(chunks)
+
+    def build_index(self):
+        """
+        split all geometries that get rendered in image tiles into chunks, to be put into a spatial index.
+        this way the renderer only has to look at the pieces that are visible in the tile, see get_cropped().
+        """
+        pieces = deque()
+
+        def add_pieces(key, geometry):
+            for chunk in self._get_index_chunks(geometry.geom if hasattr(geometry, 'geom') else geometry):
+                pieces.append((key, chunk))
+
+        if self.darken_area is not None:
+            add_pieces(('darken_area', ), self.darken_area)
+
+        for i, geoms in enumerate(self.levels):
+            add_pieces((i, 'walls'), geoms.walls)
+            add_pieces((i, 'doors'), geoms.doors)
+            for j, short_wall in enumerate(geoms.short_walls):
+                add_pieces((i, 'short_walls', j), short_wall)
+            for access_restriction, area in geoms.restricted_spaces_indoors.items():
+                add_pieces((i, 'restricted_spaces_indoors', access_restriction), area)
+            for access_restriction, area in geoms.restricted_spaces_outdoors.items():
+                add_pieces((i, 'restricted_spaces_outdoors', access_restriction), area)
+            for j, altitudearea in enumerate(geoms.altitudeareas):
+                add_pieces((i, 'altitudeareas', j), altitudearea.geometry)
+                for color, areas in altitudearea.colors.items():
+                    for access_restriction, area in areas.items():
+                        add_pieces((i, 'colors', j, color, access_restriction), area)
+                for height, height_obstacles in altitudearea.obstacles.items():
+                    for k, obstacle in enumerate(height_obstacles):
+                        add_pieces((i, 'obstacles', j, height, k), obstacle)
+
+        self.index_pieces = tuple(pieces)
+
+    @property
+    def index(self):
+        index = getattr(self, '_index', None)
+        if index is None:
+            index = Index()
+            for i, (key, geometry) in enumerate(self.index_pieces):
+                index.insert(i, geometry)
+            self._index = index
+        return index
+
+    def get_cropped(self, minx, miny, maxx, maxy):
+        """
+        get the level geometries and the darken area with all geometries that get rendered in image tiles cropped to
+        what is visible in the given area. geometries outside of it are left out or empty.
+        everything else, like the 3d meshes, stays untouched, so this is only useful for 2d rendering.
+        :return: (levels, darken_area) or None if the area is too big or there is no index
+        """
+        if getattr(self, 'index_pieces', None) is None:
+            return None
+
+        if maxx - minx > self.index_max_area_size or maxy - miny > self.index_max_area_size:
+            return None
+
+        pieces = {}
+        for i in self.index.intersection(box(minx, miny, maxx, maxy)):
+            key, geometry = self.index_pieces[i]
+            pieces.setdefault(key, []).append(geometry)
+        geometries = {key: (key_pieces[0] if len(key_pieces) == 1 else unary_union(key_pieces))
+                      for key, key_pieces in pieces.items()}
+
+        def crop(key, geometry):
+            return HybridGeometry(geometries.get(key, empty_geometry_collection), geometry.faces,
+                                  crop_ids=geometry.crop_ids, add_faces=dict(geometry.add_faces))
+
+        levels = []
+        for i, geoms in enumerate(self.levels):
+            new_geoms = copy(geoms)
+            new_geoms.walls = crop((i, 'walls'), geoms.walls)
+            new_geoms.doors = crop((i, 'doors'), geoms.doors)
+            new_geoms.short_walls = tuple(crop((i, 'short_walls', j), short_wall)
+                                          for j, short_wall in enumerate(geoms.short_walls)
+                                          if (i, 'short_walls', j) in geometries)
+            new_geoms.restricted_spaces_indoors = {
+                access_restriction: crop((i, 'restricted_spaces_indoors', access_restriction), area)
+                for access_restriction, area in geoms.restricted_spaces_indoors.items()
+                if (i, 'restricted_spaces_indoors', access_restriction) in geometries
+            }
+            new_geoms.restricted_spaces_outdoors = {
+                access_restriction: crop((i, 'restricted_spaces_outdoors', access_restriction), area)
+                for access_restriction, area in geoms.restricted_spaces_outdoors.items()
+                if (i, 'restricted_spaces_outdoors', access_restriction) in geometries
+            }
+
+            # keep all altitude areas, even if empty, the renderer needs their altitudes
+            new_geoms.altitudeareas = []
+            for j, altitudearea in enumerate(geoms.altitudeareas):
+                new_altitudearea = copy(altitudearea)
+                new_altitudearea.geometry = crop((i, 'altitudeareas', j), altitudearea.geometry)
+                new_altitudearea.colors = {}
+                for color, areas in altitudearea.colors.items():
+                    new_areas = {access_restriction: crop((i, 'colors', j, color, access_restriction), area)
+                                 for access_restriction, area in areas.items()
+                                 if (i, 'colors', j, color, access_restriction) in geometries}
+                    if new_areas:
+                        new_altitudearea.colors[color] = new_areas
+                new_altitudearea.obstacles = {}
+                for height, height_obstacles in altitudearea.obstacles.items():
+                    new_obstacles = tuple(crop((i, 'obstacles', j, height, k), obstacle)
+                                          for k, obstacle in enumerate(height_obstacles)
+                                          if (i, 'obstacles', j, height, k) in geometries)
+                    if new_obstacles:
+                        new_altitudearea.obstacles[height] = new_obstacles
+                new_geoms.altitudeareas.append(new_altitudearea)
+
+            levels.append(new_geoms)
+
+        darken_area = self.darken_area
+        if darken_area is not None:
+            darken_area = geometries.get(('darken_area', ), empty_geometry_collection)
+
+        return tuple(levels), darken_area
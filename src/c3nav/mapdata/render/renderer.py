@@ -48,6 +48,13 @@ class MapRenderer:
         else:
             levels = level_render_data.levels
 
+        darken_area = level_render_data.darken_area
+        if not self.full_levels and not engine.is_3d:
+            # only look at the geometries that are visible in this image, plus the buffer
+            cropped = level_render_data.get_cropped(engine.minx - 2, engine.miny - 2, engine.maxx + 2, engine.maxy + 2)
+            if cropped is not None:
+                levels, darken_area = cropped
+
         min_altitude = min(chain(*(tuple(area.altitude for area in geoms.altitudeareas)
                                    for geoms in levels)))
 
@@ -57,7 +64,7 @@ class MapRenderer:
             engine.add_group('level_%s' % geoms.short_label)
 
             if geoms.pk == level_render_data.lowest_important_level:
-                engine.darken(level_render_data.darken_area)
+                engine.darken(darken_area)
 
             if not bbox.intersects(geoms.affected_area):
                 continue
@@ -0,0 +1,321 @@
+import logging
+import math
+import os
+import shutil
+import tempfile
+import time
+from io import BytesIO
+
+from billiard import Pool
+from django.conf import settings
+from django.core.cache import cache
+from PIL import Image
+
+from c3nav.mapdata.render.engines import ImageRenderEngine
+from c3nav.mapdata.render.renderer import MapRenderer
+from c3nav.mapdata.utils.cache import CachePackage
+from c3nav.mapdata.utils.tiles import build_access_cache_key, build_base_cache_key, get_tile_bounds
+
+logger = logging.getLogger('c3nav')
+
+
+def get_tile_dirname(level, zoom, x, y, base_cache_key):
+    # tiles are stored by version, so outdated tiles never have to be removed on the request path, see prune_tiles()
+    return os.path.sep.join((settings.TILES_ROOT, str(level), str(zoom), str(x), str(y), base_cache_key))
+
+
+def get_cached_tile(level, zoom, x, y, base_cache_key, access_cache_key):
+    """
+    :return: tile data or None
+    """
+    tile_dirname = get_tile_dirname(level, zoom, x, y, base_cache_key)
+    try:
+        with open(os.path.join(tile_dirname, access_cache_key+'.png'), 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def save_cached_tile(level, zoom, x, y, base_cache_key, access_cache_key, data):
+    tile_dirname = get_tile_dirname(level, zoom, x, y, base_cache_key)
+    try:
+        os.makedirs(tile_dirname, exist_ok=True)
+        # write to a temporary file first, so nobody ever reads a half-written tile
+        fd, tmp_filename = tempfile.mkstemp(dir=tile_dirname, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_filename, os.path.join(tile_dirname, access_cache_key+'.png'))
+    except OSError as e:
+        # the version might just have been pruned
+        logger.warning('Writing tile to tile cache failed: %s' % e)
+
+
+def render_tile(level, zoom, x, y, access_permissions):
+    minx, miny, maxx, maxy = get_tile_bounds(zoom, x, y)
+    renderer = MapRenderer(level, minx, miny, maxx, maxy, scale=2 ** zoom, access_permissions=access_permissions)
+    image = renderer.render(ImageRenderEngine)
+    return image.render()
+
+
+def get_metatile(cache_package, zoom, x, y, metatile_size=None):
+    """
+    get the tiles of the metatile that contains the given tile. metatiles are aligned to multiples of their size.
+    :return: tuple of (x, y), only tiles within the map bounds
+    """
+    if metatile_size is None:
+        metatile_size = settings.METATILE_SIZE
+    x0 = x // metatile_size * metatile_size
+    y0 = y // metatile_size * metatile_size
+    return tuple((tile_x, tile_y)
+                 for tile_y in range(y0, y0 + metatile_size)
+                 for tile_x in range(x0, x0 + metatile_size)
+                 if cache_package.bounds_valid(*get_tile_bounds(zoom, tile_x, tile_y)))
+
+
+def render_metatile(cache_package, level, zoom, x, y, access_permissions, metatile_size=None, skip_cached=False):
+    """
+    render the metatile containing the given tile in one pass, slice it into tiles and save them to the tile cache.
+    this way the level geometries are walked and the image is rasterized once for all tiles of the metatile.
+    tiles of a metatile overlap by one pixel, just like single tiles.
+    :param skip_cached: only render if one of the tiles is not cached yet
+    :return: dict of (x, y) -> tile data for all rendered tiles
+    """
+    tiles = get_metatile(cache_package, zoom, x, y, metatile_size)
+    if (x, y) not in tiles:
+        tiles += ((x, y), )
+
+    level_data = cache_package.levels[level]
+    cache_keys = {}
+    missing = set()
+    for tile_x, tile_y in tiles:
+        minx, miny, maxx, maxy = get_tile_bounds(zoom, tile_x, tile_y)
+        base_cache_key = build_base_cache_key(level_data.history.last_update(minx, miny, maxx, maxy))
+        access_cache_key = build_access_cache_key(access_permissions &
+                                                  set(level_data.restrictions[minx:maxx, miny:maxy]))
+        if get_cached_tile(level, zoom, tile_x, tile_y, base_cache_key, access_cache_key) is None:
+            missing.add((tile_x, tile_y))
+        cache_keys[(tile_x, tile_y)] = (base_cache_key, access_cache_key)
+
+    if skip_cached and not missing:
+        return {}
+
+    if len(tiles) == 1:
+        results = {(x, y): render_tile(level, zoom, x, y, access_permissions)}
+    else:
+        min_x = min(tile_x for tile_x, tile_y in tiles)
+        min_y = min(tile_y for tile_x, tile_y in tiles)
+        minx, miny, maxx, maxy = get_tile_bounds(zoom, min_x, max(tile_y for tile_x, tile_y in tiles))
+        maxx, maxy = get_tile_bounds(zoom, max(tile_x for tile_x, tile_y in tiles), min_y)[2:]
+        renderer = MapRenderer(level, minx, miny, maxx, maxy, scale=2 ** zoom, access_permissions=access_permissions)
+        image = Image.open(BytesIO(renderer.render(ImageRenderEngine).render()))
+
+        results = {}
+        for tile_x, tile_y in tiles:
+            left = (tile_x - min_x) * 256
+            top = (tile_y - min_y) * 256
+            f = BytesIO()
+            image.crop((left, top, left + 257, top + 257)).save(f, 'PNG')
+            results[(tile_x, tile_y)] = f.getvalue()
+
+    for tile_x, tile_y in missing:
+        save_cached_tile(level, zoom, tile_x, tile_y, *cache_keys[(tile_x, tile_y)], data=results[(tile_x, tile_y)])
+
+    return results
+
+
+def get_metatile_lock_key(cache_package, level, zoom, x, y, access_cache_key):
+    # the lock covers the whole metatile, so it has to use the last update of the whole metatile
+    tiles = get_metatile(cache_package, zoom, x, y) or ((x, y), )
+    minx, miny = get_tile_bounds(zoom, tiles[0][0], tiles[-1][1])[:2]
+    maxx, maxy = get_tile_bounds(zoom, tiles[-1][0], tiles[0][1])[2:]
+    base_cache_key = build_base_cache_key(cache_package.levels[level].history.last_update(minx, miny, maxx, maxy))
+    return 'mapdata:tiles:render:%d:%d:%d:%d:%s:%s' % ((level, zoom) + tiles[0] + (base_cache_key, access_cache_key))
+
+
+render_lock_timeout = 30
+render_lock_poll_interval = 0.05
+
+
+def get_or_render_tile(cache_package, level, zoom, x, y, access_permissions, base_cache_key, access_cache_key):
+    """
+    get the tile from the tile cache or render its metatile. concurrent requests for tiles of the same metatile
+    don't render it again, they wait for the one that is rendering it and read the result from the tile cache.
+    :return: tile data
+    """
+    data = get_cached_tile(level, zoom, x, y, base_cache_key, access_cache_key)
+    if data is not None:
+        return data
+
+    lock_key = get_metatile_lock_key(cache_package, level, zoom, x, y, access_cache_key)
+    deadline = time.time() + render_lock_timeout
+    while not cache.add(lock_key, True, render_lock_timeout):
+        # someone else is rendering this metatile
+        if time.time() > deadline:
+            logger.warning('Waiting for metatile %s timed out, rendering it ourselves.' % lock_key)
+            return render_metatile(cache_package, level, zoom, x, y, access_permissions)[(x, y)]
+        time.sleep(render_lock_poll_interval)
+        data = get_cached_tile(level, zoom, x, y, base_cache_key, access_cache_key)
+        if data is not None:
+            return data
+
+    try:
+        # the tile might have been rendered while we were waiting for the lock
+        data = get_cached_tile(level, zoom, x, y, base_cache_key, access_cache_key)
+        if data is None:
+            data = render_metatile(cache_package, level, zoom, x, y, access_permissions)[(x, y)]
+    finally:
+        cache.delete(lock_key)
+    return data
+
+
+def get_changed_tiles(cache_package, level, zoom, since_update=None):
+    """
+    get all tiles of a level at a zoom level that have changed since the given update, according to its map history
+    :return: generator of (x, y, bounds, last_update)
+    """
+    level_data = cache_package.levels[level]
+    history = level_data.history
+
+    if since_update is not None:
+        # get the area that changed
+        since_update = tuple(since_update)
+        new_updates = [i for i, update in enumerate(history.updates) if tuple(update) > since_update]
+        if not new_updates:
+            return
+        changed_y, changed_x = (history.data >= new_updates[0]).nonzero()
+        if not changed_x.size:
+            return
+        res = history.resolution
+        minx = (history.x + changed_x.min()) * res
+        miny = (history.y + changed_y.min()) * res
+        maxx = (history.x + changed_x.max() + 1) * res
+        maxy = (history.y + changed_y.max() + 1) * res
+    else:
+        minx, miny, maxx, maxy = cache_package.bounds
+
+    # look at every tile in the area. tiles overlap by one pixel, so take a few more.
+    size = 256 / 2 ** zoom
+    for x in range(int(math.floor(minx / size)) - 1, int(math.ceil(maxx / size)) + 1):
+        for y in range(int(math.floor(-maxy / size)) - 1, int(math.ceil(-miny / size)) + 1):
+            bounds = get_tile_bounds(zoom, x, y)
+            if not cache_package.bounds_valid(*bounds):
+                continue
+            last_update = history.last_update(*bounds)
+            if since_update is None or tuple(last_update) > since_update:
+                yield x, y, bounds, last_update
+
+
+def get_tiles_to_warm(cache_package, zooms, permission_sets, since_update=None):
+    """
+    get all metatiles that have to be rendered to warm the tile cache, for every distinct permission set.
+    :return: generator of (level, zoom, x, y, access_permissions), x and y being a tile of the metatile
+    """
+    for level in sorted(cache_package.levels.keys()):
+        restrictions = cache_package.levels[level].restrictions
+        for zoom in zooms:
+            metatiles = set()
+            for x, y, bounds, last_update in get_changed_tiles(cache_package, level, zoom, since_update):
+                tiles = get_metatile(cache_package, zoom, x, y)
+                if tiles[0] in metatiles:
+                    continue
+                metatiles.add(tiles[0])
+
+                minx, miny = get_tile_bounds(zoom, tiles[0][0], tiles[-1][1])[:2]
+                maxx, maxy = get_tile_bounds(zoom, tiles[-1][0], tiles[0][1])[2:]
+                metatile_restrictions = set(restrictions[minx:maxx, miny:maxy])
+                access_cache_keys = set()
+                for permissions in permission_sets:
+                    access_permissions = set(permissions) & metatile_restrictions
+                    access_cache_key = build_access_cache_key(access_permissions)
+                    if access_cache_key in access_cache_keys:
+                        continue
+                    access_cache_keys.add(access_cache_key)
+                    yield level, zoom, x, y, access_permissions
+
+
+def warm_metatile(metatile):
+    level, zoom, x, y, access_permissions = metatile
+    return len(render_metatile(CachePackage.open_cached(), level, zoom, x, y, access_permissions, skip_cached=True))
+
+
+def warm_tiles(zooms, permission_sets, since_update=None, processes=None):
+    """
+    pre-render all tiles that changed since the given update into the tile cache, so visitors get them right away.
+    metatiles are rendered in a process pool, unless processes=1.
+    :return: number of rendered tiles
+    """
+    start = time.time()
+    cache_package = CachePackage.open_cached()
+    metatiles = get_tiles_to_warm(cache_package, zooms, permission_sets, since_update)
+
+    if processes == 1:
+        rendered = sum(map(warm_metatile, metatiles))
+    else:
+        # don't share database connections with the forked workers
+        from django.db import connections
+        connections.close_all()
+        # billiard's pool, unlike the one from multiprocessing, can also be started by daemonic celery workers
+        pool = Pool(processes=processes)
+        try:
+            rendered = sum(pool.imap_unordered(warm_metatile, metatiles, chunksize=4))
+        finally:
+            pool.terminate()
+            pool.join()
+
+    logger.info('%d tiles rendered in %.3f s.' % (rendered, time.time() - start))
+    return rendered
+
+
+def _listdir_ints(dirname):
+    # other files or directories might have been put here by someone else, leave them alone
+    for name in os.listdir(dirname):
+        try:
+            number = int(name)
+        except ValueError:
+            continue
+        yield number, os.path.join(dirname, name)
+
+
+def _remove_path(path):
+    """
+    :return: whether the path is gone
+    """
+    try:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        # a worker might be writing a tile into it right now
+        logger.warning('Removing %s from the tile cache failed: %s' % (path, e))
+        return False
+    return True
+
+
+def prune_tiles():
+    """
+    remove all tile versions from the tile cache that are superseded by the current map history,
+    as well as tiles of levels that no longer exist.
+    :return: number of removed tile versions
+    """
+    start = time.time()
+    cache_package = CachePackage.open()
+    removed = 0
+    for level, level_dirname in _listdir_ints(settings.TILES_ROOT):
+        level_data = cache_package.levels.get(level)
+        if level_data is None:
+            _remove_path(level_dirname)
+            continue
+        for zoom, zoom_dirname in _listdir_ints(level_dirname):
+            for x, x_dirname in _listdir_ints(zoom_dirname):
+                for y, y_dirname in _listdir_ints(x_dirname):
+                    bounds = get_tile_bounds(zoom, x, y)
+                    current = build_base_cache_key(level_data.history.last_update(*bounds))
+                    for name in os.listdir(y_dirname):
+                        if name != current and _remove_path(os.path.join(y_dirname, name)):
+                            removed += 1
+
+    logger.info('%d tile versions pruned in %.3f s.' % (removed, time.time() - start))
+    return removed
@@ -1,6 +1,7 @@
 import logging
 
 from celery.exceptions import MaxRetriesExceededError
+from django.conf import settings
 from django.utils.formats import date_format
 from django.utils.translation import ugettext_lazy as _
 from django.utils.translation import ungettext_lazy
@@ -18,6 +19,7 @@ def process_map_updates(self):
         logger.info('Processing map updates...')
 
     from c3nav.mapdata.models import MapUpdate
+    last_processed_update = MapUpdate.last_processed_update()
     try:
         try:
             updates = MapUpdate.process_updates()
@@ -40,3 +42,28 @@ def process_map_updates(self):
             'date': date_format(updates[-1].datetime, 'DATETIME_FORMAT'),
             'id': updates[-1].pk,
         })
+
+        if settings.CACHE_TILES:
+            prune_tile_cache.delay()
+            if settings.TILE_WARM_ZOOMS:
+                if settings.HAS_CELERY:
+                    warm_tile_cache.delay(since_update=last_processed_update)
+                else:
+                    # without celery, tasks run eagerly, this would block until the whole tile cache is rendered
+                    logger.info('No celery, not warming the tile cache. Run the warmtiles command to do so.')
+
+
+@app.task(bind=True)
+def warm_tile_cache(self, since_update=None):
+    logger.info('Warming tile cache...')
+
+    from c3nav.mapdata.render.tiles import warm_tiles
+    warm_tiles(settings.TILE_WARM_ZOOMS, settings.TILE_WARM_PERMISSIONS, since_update=since_update)
+
+
+@app.task(bind=True)
+def prune_tile_cache(self):
+    logger.info('Pruning tile cache...')
+
+    from c3nav.mapdata.render.tiles import prune_tiles
+    prune_tiles()
@@ -1,6 +1,6 @@
 from django.conf.urls import url
 
-from c3nav.mapdata.views import get_cache_package, map_history, tile
+from c3nav.mapdata.views import get_cache_package, get_cache_package_delta, map_history, tile
 
 urlpatterns = [
     url(r'^(?P<level>\d+)/(?P<zoom>-?\d+)/(?P<x>-?\d+)/(?P<y>-?\d+).png$', tile, name='mapdata.tile'),
@@ -9,4 +9,5 @@ urlpatterns = [
     url(r'^history/(?P<level>\d+)/(?P<mode>base|composite)\.(?P<filetype>png|data)$', map_history,
         name='mapdata.map_history'),
     url(r'^cache/package\.(?P<filetype>tar|tar\.gz|tar\.xz)$', get_cache_package, name='mapdata.cache_package'),
+    url(r'^cache/package\.delta\.tar$', get_cache_package_delta, name='mapdata.cache_package_delta'),
 ]
@@ -1,4 +1,4 @@
 from c3nav.mapdata.utils.cache.indexed import GeometryIndexed  # noqa
 from c3nav.mapdata.utils.cache.maphistory import MapHistory  # noqa
 from c3nav.mapdata.utils.cache.accessrestrictions import AccessRestrictionAffected  # noqa
-from c3nav.mapdata.utils.cache.package import CachePackage  # noqa
+from c3nav.mapdata.utils.cache.package import CachePackage, CachePackageBaseMismatch  # noqa
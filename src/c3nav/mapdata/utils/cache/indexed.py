@@ -41,7 +41,10 @@ class GeometryIndexed:
         return instance
 
     @classmethod
-    def read(cls, f):
+    def read(cls, f, buffer=None):
+        """
+        :param buffer: if f is a file over a buffer (like a mmap), the data array is a read-only view into it
+        """
         variant_id, resolution, x, y, width, height = struct.unpack('<BBHHHH', f.read(10))
         if variant_id != cls.variant_id:
             raise ValueError('variant id does not match')
@@ -53,8 +56,12 @@ class GeometryIndexed:
         }
         cls._read_metadata(f, kwargs)
 
-        # noinspection PyTypeChecker
-        kwargs['data'] = np.fromstring(f.read(width*height*cls.dtype().itemsize), cls.dtype).reshape((height, width))
+        if buffer is None:
+            # noinspection PyTypeChecker
+            data = np.fromstring(f.read(width*height*cls.dtype().itemsize), cls.dtype)
+        else:
+            data = np.frombuffer(buffer, cls.dtype, count=width*height, offset=f.tell())
+        kwargs['data'] = data.reshape((height, width))
         return cls(**kwargs)
 
     @classmethod
@@ -1,7 +1,11 @@
+import hashlib
+import json
+import mmap
 import os
 import struct
 import threading
 from collections import namedtuple
+from copy import copy
 from io import BytesIO
 from tarfile import TarFile, TarInfo
 
@@ -10,10 +14,18 @@ from c3nav.mapdata.utils.cache import AccessRestrictionAffected, GeometryIndexed
 CachePackageLevel = namedtuple('CachePackageLevel', ('history', 'restrictions'))
 
 
+class CachePackageBaseMismatch(ValueError):
+    pass
+
+
 class CachePackage:
-    def __init__(self, bounds, levels=None):
+    def __init__(self, bounds, levels=None, level_hashes=None):
+        """
+        :param level_hashes: level hashes as in the manifest, only known for packages built from a delta package
+        """
         self.bounds = bounds
         self.levels = {} if levels is None else levels
+        self.level_hashes = level_hashes
 
     def add_level(self, level_id: int, history: MapHistory, restrictions: AccessRestrictionAffected):
         self.levels[level_id] = CachePackageLevel(history, restrictions)
@@ -29,14 +41,19 @@ class CachePackage:
         if compression is not None:
             filemode += ':' + compression
 
-        with TarFile.open(filename, filemode) as f:
+        # write to a temporary file first, the old file might be memory mapped somewhere
+        with TarFile.open(filename+'.tmp', filemode) as f:
             self._add_bytesio(f, 'bounds', BytesIO(struct.pack('<IIII', *(int(i*100) for i in self.bounds))))
+            if self.level_hashes is not None:
+                self._add_bytesio(f, 'level_hashes', BytesIO(json.dumps(self.level_hashes).encode()))
 
             for level_id, level_data in self.levels.items():
                 self._add_geometryindexed(f, 'history_%d' % level_id, level_data.history)
                 self._add_geometryindexed(f, 'restrictions_%d' % level_id, level_data.restrictions)
+        os.replace(filename+'.tmp', filename)
 
-    def _add_bytesio(self, f: TarFile, filename: str, data: BytesIO):
+    @staticmethod
+    def _add_bytesio(f: TarFile, filename: str, data: BytesIO):
         data.seek(0, os.SEEK_END)
         tarinfo = TarInfo(name=filename)
         tarinfo.size = data.tell()
@@ -51,32 +68,164 @@ class CachePackage:
     def save_all(self, filename=None):
         for compression in (None, 'gz', 'xz'):
             self.save(filename, compression)
+        self.save_levels()
+
+    @staticmethod
+    def get_levels_dirname():
+        from django.conf import settings
+        return os.path.join(settings.CACHE_ROOT, 'package_levels')
+
+    @staticmethod
+    def get_level_filename(level_id, level_hash):
+        return 'level_%d_%s.tar.xz' % (level_id, level_hash)
+
+    def save_levels(self, dirname=None):
+        """
+        save every level as its own compressed package, named by a hash of its content, and a manifest listing them.
+        this lets tile servers download only the levels that changed, see write_delta()
+        """
+        if dirname is None:
+            dirname = self.get_levels_dirname()
+        if not os.path.exists(dirname):
+            os.mkdir(dirname)
+
+        level_hashes = {}
+        for level_id, level_data in self.levels.items():
+            history, restrictions = BytesIO(), BytesIO()
+            level_data.history.write(history)
+            level_data.restrictions.write(restrictions)
+            level_hash = hashlib.sha256(history.getvalue()+restrictions.getvalue()).hexdigest()[:16]
+            level_hashes[level_id] = level_hash
+
+            filename = os.path.join(dirname, self.get_level_filename(level_id, level_hash))
+            if not os.path.exists(filename):
+                with TarFile.open(filename+'.tmp', 'w:xz') as f:
+                    self._add_bytesio(f, 'history_%d' % level_id, history)
+                    self._add_bytesio(f, 'restrictions_%d' % level_id, restrictions)
+                os.replace(filename+'.tmp', filename)
+
+        # level packages of the previous manifest are kept, deltas might still be written from it
+        try:
+            with open(os.path.join(dirname, 'manifest.json'), 'r') as f:
+                previous_level_hashes = {int(level_id): level_hash
+                                         for level_id, level_hash in json.load(f)['levels'].items()}
+        except (OSError, ValueError, KeyError):
+            previous_level_hashes = {}
+
+        with open(os.path.join(dirname, 'manifest.json.tmp'), 'w') as f:
+            json.dump({
+                'bounds': self.bounds,
+                'levels': {str(level_id): level_hash for level_id, level_hash in level_hashes.items()},
+            }, f)
+        os.replace(os.path.join(dirname, 'manifest.json.tmp'), os.path.join(dirname, 'manifest.json'))
+
+        # remove level packages that neither the new nor the previous manifest need
+        filenames = set(self.get_level_filename(*item)
+                        for item in tuple(level_hashes.items())+tuple(previous_level_hashes.items()))
+        for filename in os.listdir(dirname):
+            if filename.startswith('level_') and filename not in filenames:
+                os.remove(os.path.join(dirname, filename))
+
+    @classmethod
+    def write_delta(cls, f, level_hashes, dirname=None):
+        """
+        write a delta package: an uncompressed tar with the manifest and the compressed level packages
+        that differ from the given level hashes, which are the ones the client already has.
+        """
+        if dirname is None:
+            dirname = cls.get_levels_dirname()
+        with open(os.path.join(dirname, 'manifest.json'), 'rb') as manifest_file:
+            manifest_data = manifest_file.read()
+        manifest = json.loads(manifest_data.decode())
+
+        with TarFile.open(fileobj=f, mode='w') as tar:
+            cls._add_bytesio(tar, 'manifest.json', BytesIO(manifest_data))
+            for level_id, level_hash in manifest['levels'].items():
+                if level_hashes.get(int(level_id)) != level_hash:
+                    filename = cls.get_level_filename(int(level_id), level_hash)
+                    tar.add(os.path.join(dirname, filename), arcname=filename)
+
+    @classmethod
+    def read_delta(cls, f, base=None):
+        """
+        read a delta package, levels that were not included are taken from the base package.
+        the base package has to have the level hashes the delta package expects for these levels,
+        it might not be the one the delta package was requested for.
+        :raises CachePackageBaseMismatch: if it doesn't, get the full package then
+        :return: cache package
+        """
+        tar = TarFile.open(fileobj=f)
+        manifest = json.loads(tar.extractfile('manifest.json').read().decode())
+        level_hashes = {int(level_id): level_hash for level_id, level_hash in manifest['levels'].items()}
+
+        levels = {}
+        for level_id, level_hash in level_hashes.items():
+            filename = cls.get_level_filename(level_id, level_hash)
+            try:
+                level_file = tar.extractfile(filename)
+            except KeyError:
+                if base is None or level_id not in base.levels:
+                    raise ValueError('Level %d is missing in the delta package.' % level_id)
+                if base.level_hashes is None or base.level_hashes.get(level_id) != level_hash:
+                    raise CachePackageBaseMismatch('Level %d of the base package does not match.' % level_id)
+                # the base package is usually memory mapped, so its arrays are read-only. saving needs to
+                # simplify the history in place, so copy them.
+                history, restrictions = copy(base.levels[level_id].history), copy(base.levels[level_id].restrictions)
+                history.data, restrictions.data = history.data.copy(), restrictions.data.copy()
+                levels[level_id] = CachePackageLevel(history, restrictions)
+                continue
+            level_tar = TarFile.open(fileobj=BytesIO(level_file.read()), mode='r:xz')
+            levels[level_id] = CachePackageLevel(
+                history=MapHistory.read(level_tar.extractfile('history_%d' % level_id)),
+                restrictions=AccessRestrictionAffected.read(level_tar.extractfile('restrictions_%d' % level_id))
+            )
+
+        return cls(tuple(manifest['bounds']), levels, level_hashes)
 
     @classmethod
-    def read(cls, f):
+    def read(cls, f, buffer=None):
+        """
+        :param buffer: if f is an uncompressed package in a buffer (like a mmap), arrays are views into it
+        """
         f = TarFile.open(fileobj=f)
         files = {info.name: info for info in f.getmembers()}
 
+        def read_member(indexed_cls, name):
+            if buffer is None:
+                return indexed_cls.read(f.extractfile(files[name]))
+            buffer.seek(files[name].offset_data)
+            return indexed_cls.read(buffer, buffer=buffer)
+
         bounds = tuple(i/100 for i in struct.unpack('<IIII', f.extractfile(files['bounds']).read()))
 
+        level_hashes = None
+        if 'level_hashes' in files:
+            level_hashes = {int(level_id): level_hash for level_id, level_hash
+                            in json.loads(f.extractfile(files['level_hashes']).read().decode()).items()}
+
         levels = {}
         for filename in files:
             if not filename.startswith('history_'):
                 continue
             level_id = int(filename[8:])
             levels[level_id] = CachePackageLevel(
-                history=MapHistory.read(f.extractfile(files['history_%d' % level_id])),
-                restrictions=AccessRestrictionAffected.read(f.extractfile(files['restrictions_%d' % level_id]))
+                history=read_member(MapHistory, 'history_%d' % level_id),
+                restrictions=read_member(AccessRestrictionAffected, 'restrictions_%d' % level_id)
             )
 
-        return cls(bounds, levels)
+        return cls(bounds, levels, level_hashes)
 
     @classmethod
     def open(cls, filename=None):
+        """
+        open an uncompressed package. it is memory mapped, so all processes share one copy of the data.
+        """
         if filename is None:
             from django.conf import settings
             filename = os.path.join(settings.CACHE_ROOT, 'package.tar')
-        return cls.read(open(filename, 'rb'))
+        with open(filename, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls.read(buffer, buffer=buffer)
 
     cached = None
     cache_key = None
@@ -24,7 +24,7 @@ except OSError:
             self.objects.pop(value)
 
         def intersection(self, geometry):
-            return self.objects.values()
+            return self.objects.keys()
 else:
     rtree_index = True
 
@@ -3,7 +3,6 @@ import os
 from wsgiref.util import FileWrapper
 
 from django.conf import settings
-from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
 from django.http import Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
@@ -12,8 +11,7 @@ from django.views.decorators.http import etag
 from c3nav.mapdata.middleware import no_language
 from c3nav.mapdata.models import Level, MapUpdate
 from c3nav.mapdata.models.access import AccessPermission
-from c3nav.mapdata.render.engines import ImageRenderEngine
-from c3nav.mapdata.render.renderer import MapRenderer
+from c3nav.mapdata.render.tiles import get_or_render_tile, render_tile
 from c3nav.mapdata.utils.cache import CachePackage, MapHistory
 from c3nav.mapdata.utils.tiles import (build_access_cache_key, build_base_cache_key, build_tile_access_cookie,
                                        build_tile_etag, get_tile_bounds, parse_tile_access_cookie)
@@ -94,46 +92,11 @@ def tile(request, level, zoom, x, y, access_permissions=None):
     if if_none_match == tile_etag:
         return HttpResponseNotModified()
 
-    data = None
-    tile_dirname, last_update_filename, tile_filename, tile_cache_update_cache_key = '', '', '', ''
-
-    # get tile cache last update
     if settings.CACHE_TILES:
-        tile_dirname = os.path.sep.join((settings.TILES_ROOT, str(level), str(zoom), str(x), str(y)))
-        last_update_filename = os.path.join(tile_dirname, 'last_update')
-        tile_filename = os.path.join(tile_dirname, access_cache_key+'.png')
-
-        # get tile cache last update
-        tile_cache_update_cache_key = 'mapdata:tile-cache-update:%d-%d-%d-%d' % (level, zoom, x, y)
-        tile_cache_update = cache.get(tile_cache_update_cache_key, None)
-        if tile_cache_update is None:
-            try:
-                with open(last_update_filename) as f:
-                    tile_cache_update = f.read()
-            except FileNotFoundError:
-                pass
-
-        if tile_cache_update != base_cache_key:
-            os.system('rm -rf '+os.path.join(tile_dirname, '*'))
-        else:
-            try:
-                with open(tile_filename, 'rb') as f:
-                    data = f.read()
-            except FileNotFoundError:
-                pass
-
-    if data is None:
-        renderer = MapRenderer(level, minx, miny, maxx, maxy, scale=2 ** zoom, access_permissions=access_permissions)
-        image = renderer.render(ImageRenderEngine)
-        data = image.render()
-
-        if settings.CACHE_TILES:
-            os.makedirs(tile_dirname, exist_ok=True)
-            with open(tile_filename, 'wb') as f:
-                f.write(data)
-            with open(last_update_filename, 'w') as f:
-                f.write(base_cache_key)
-            cache.set(tile_cache_update_cache_key, base_cache_key, 60)
+        data = get_or_render_tile(cache_package, level, zoom, x, y, access_permissions,
+                                  base_cache_key, access_cache_key)
+    else:
+        data = render_tile(level, zoom, x, y, access_permissions)
 
     response = HttpResponse(data, 'image/png')
     response['ETag'] = tile_etag
@@ -183,3 +146,22 @@ def get_cache_package(request, filetype):
     response = StreamingHttpResponse(FileWrapper(f), content_type=content_type)
     response['Content-Length'] = size
     return response
+
+
+@etag(lambda *args, **kwargs: MapUpdate.current_processed_cache_key())
+@no_language()
+def get_cache_package_delta(request):
+    """
+    only the levels that changed compared to the ones the client has: ?levels=<level_id>:<hash>,…
+    """
+    enforce_tile_secret_auth(request)
+
+    level_hashes = {}
+    for item in request.GET.get('levels', '').split(','):
+        level_id, sep, level_hash = item.partition(':')
+        if level_id.isdigit() and level_hash:
+            level_hashes[int(level_id)] = level_hash
+
+    response = HttpResponse(content_type='application/x-tar')
+    CachePackage.write_delta(response, level_hashes)
+    return response
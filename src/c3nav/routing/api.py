@@ -1,3 +1,6 @@
+from collections import OrderedDict
+from itertools import chain
+
 from django.core.exceptions import ValidationError
 from django.utils.translation import ugettext_lazy as _
 from rest_framework.decorators import list_route
@@ -5,20 +8,51 @@ from rest_framework.response import Response
 from rest_framework.viewsets import ViewSet
 
 from c3nav.mapdata.models.access import AccessPermission
-from c3nav.mapdata.utils.locations import visible_locations_for_request
+from c3nav.mapdata.models.locations import LocationRedirect
+from c3nav.mapdata.utils.locations import (get_location_by_id_for_request, get_location_by_slug_for_request,
+                                           visible_locations_for_request)
 from c3nav.routing.exceptions import LocationUnreachable, NoRouteFound, NotYetRoutable
 from c3nav.routing.forms import RouteForm
-from c3nav.routing.locator import Locator
+from c3nav.routing.locator import Locator, LocatorSession
 from c3nav.routing.models import RouteOptions
 from c3nav.routing.router import Router
 
 
+def is_location_value(value):
+    # json booleans are ints in python, but no location ids
+    return isinstance(value, (str, int)) and not isinstance(value, bool)
+
+
+def get_location_for_request(value, request):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int) or value.isdigit():
+        return get_location_by_id_for_request(value, request)
+    location = get_location_by_slug_for_request(value, request)
+    if isinstance(location, LocationRedirect):
+        location = location.target
+    return location
+
+
+routing_errors = {
+    NotYetRoutable: _('Not yet routable, try again shortly.'),
+    LocationUnreachable: _('Unreachable location.'),
+    NoRouteFound: _('No route found.'),
+}
+
+
 class RoutingViewSet(ViewSet):
     """
     /route/ Get routes.
+    /batch/ Get many routes with the same options at once.
+    /matrix/ Get distances and durations between two sets of locations.
     /options/ Get or set route options.
     /locate/ Wifi locate.
     """
+    max_batch_size = 1000
+    max_matrix_size = 10000
+    max_locate_neighbors = 16
+
     @list_route(methods=['get', 'post'])
     def route(self, request, *args, **kwargs):
         params = request.POST if request.method == 'POST' else request.GET
@@ -42,17 +76,9 @@ class RoutingViewSet(ViewSet):
                                             destination=form.cleaned_data['destination'],
                                             permissions=AccessPermission.get_for_request(request),
                                             options=options)
-        except NotYetRoutable:
-            return Response({
-                'error': _('Not yet routable, try again shortly.'),
-            })
-        except LocationUnreachable:
-            return Response({
-                'error': _('Unreachable location.'),
-            })
-        except NoRouteFound:
+        except (NotYetRoutable, LocationUnreachable, NoRouteFound) as e:
             return Response({
-                'error': _('No route found.'),
+                'error': routing_errors[type(e)],
             })
 
         return Response({
@@ -64,6 +90,114 @@ class RoutingViewSet(ViewSet):
             'result': route.serialize(locations=visible_locations_for_request(request)),
         })
 
+    @list_route(methods=['post'])
+    def batch(self, request, *args, **kwargs):
+        """
+        Either a list of routes ({"routes": [{"origin": …, "destination": …}, …]}) or one origin with many
+        destinations ({"origin": …, "destinations": […]}), with location ids or slugs.
+        Optional: "options" to override route options, "items": true to include the full route items.
+        """
+        data = request.data
+        if 'routes' in data:
+            pairs = data['routes']
+            if not isinstance(pairs, list) or not all(isinstance(pair, dict) for pair in pairs):
+                return Response({'errors': (_('Invalid list of routes.'), )}, status=400)
+            pairs = tuple((pair.get('origin'), pair.get('destination')) for pair in pairs)
+        elif 'origin' in data and 'destinations' in data:
+            if not isinstance(data['destinations'], list):
+                return Response({'errors': (_('Invalid list of destinations.'), )}, status=400)
+            pairs = tuple((data['origin'], destination) for destination in data['destinations'])
+        else:
+            return Response({'errors': (_('Specify routes or an origin and destinations.'), )}, status=400)
+
+        if len(pairs) > self.max_batch_size:
+            return Response({'errors': (_('Too many routes, the maximum is %d.') % self.max_batch_size, )},
+                            status=400)
+
+        options = RouteOptions.get_for_request(request)
+        try:
+            options.update(data.get('options'), ignore_unknown=True)
+        except (ValidationError, AttributeError) as e:
+            return Response({
+                'errors': (str(e), ),
+            }, status=400)
+
+        # resolve every location only once
+        if not all(is_location_value(value) for value in chain(*pairs)):
+            return Response({'errors': (_('Invalid location id.'), )}, status=400)
+        locations = {value: get_location_for_request(value, request) for value in set(chain(*pairs))}
+
+        results = [OrderedDict((('request', {'origin': origin, 'destination': destination}), ))
+                   for origin, destination in pairs]
+        valid_pairs = OrderedDict()
+        for i, (origin, destination) in enumerate(pairs):
+            if locations[origin] is None:
+                results[i]['error'] = _('Unknown origin.')
+            elif locations[destination] is None:
+                results[i]['error'] = _('Unknown destination.')
+            else:
+                valid_pairs[i] = (locations[origin], locations[destination])
+
+        routes = Router.load().get_routes(tuple(valid_pairs.values()),
+                                          permissions=AccessPermission.get_for_request(request), options=options)
+
+        visible_locations = visible_locations_for_request(request)
+        include_items = bool(data.get('items', False))
+        for i, route in zip(valid_pairs.keys(), routes):
+            if isinstance(route, Exception):
+                results[i]['error'] = routing_errors[type(route)]
+            else:
+                results[i]['result'] = route.serialize(locations=visible_locations, include_items=include_items)
+
+        return Response({
+            'options': options.serialize(),
+            'results': results,
+        })
+
+    @list_route(methods=['post'])
+    def matrix(self, request, *args, **kwargs):
+        """
+        {"origins": […], "destinations": […]} with location ids or slugs.
+        A group is one origin or destination, routed from or to its nearest member.
+        Optional: "options" to override route options.
+        """
+        data = request.data
+        origins = data.get('origins')
+        destinations = data.get('destinations')
+        if not isinstance(origins, list) or not isinstance(destinations, list) or not origins or not destinations:
+            return Response({'errors': (_('Specify origins and destinations.'), )}, status=400)
+        if not all(is_location_value(value) for value in chain(origins, destinations)):
+            return Response({'errors': (_('Invalid location id.'), )}, status=400)
+        if len(origins) * len(destinations) > self.max_matrix_size:
+            return Response({'errors': (_('Too many routes, the maximum is %d.') % self.max_matrix_size, )},
+                            status=400)
+
+        options = RouteOptions.get_for_request(request)
+        try:
+            options.update(data.get('options'), ignore_unknown=True)
+        except (ValidationError, AttributeError) as e:
+            return Response({
+                'errors': (str(e), ),
+            }, status=400)
+
+        locations = {value: get_location_for_request(value, request) for value in set(chain(origins, destinations))}
+        unknown = tuple(value for value, location in locations.items() if location is None)
+        if unknown:
+            return Response({'errors': (_('Unknown location: %s') % ', '.join(str(value) for value in unknown), )},
+                            status=400)
+
+        matrix = Router.load().get_matrix(origins=tuple(locations[value] for value in origins),
+                                          destinations=tuple(locations[value] for value in destinations),
+                                          permissions=AccessPermission.get_for_request(request), options=options)
+
+        return Response({
+            'options': options.serialize(),
+            'origins': origins,
+            'destinations': destinations,
+            'distances': tuple(tuple((None if result is None else result[0]) for result in row) for row in matrix),
+            'durations': tuple(tuple((None if result is None else result[1]) for result in row) for row in matrix),
+        })
+
     @list_route(methods=['get', 'post'])
     def options(self, request, *args, **kwargs):
         options = RouteOptions.get_for_request(request)
@@ -81,11 +215,54 @@ class RoutingViewSet(ViewSet):
 
     @list_route(methods=('POST', ))
     def locate(self, request, *args, **kwargs):
+        """
+        Optional: ?neighbors=<k> to interpolate between the k best matching measurements,
+        the response then also contains the uncertainty radius in meters as "accuracy".
+        Optional: ?session=1 for clients that send scans continuously, searches near the last fix of the session first
+        and smoothes the result over the recent fixes.
+        """
+        session = request.GET.get('session') == '1'
+        neighbors = request.GET.get('neighbors')
+        if session and neighbors is not None:
+            return Response({
+                'errors': (_('session and neighbors can not be combined.'),),
+            }, status=400)
+        if neighbors is not None:
+            if not neighbors.isdigit() or not (1 <= int(neighbors) <= self.max_locate_neighbors):
+                return Response({
+                    'errors': (_('neighbors has to be between 1 and %d.') % self.max_locate_neighbors,),
+                }, status=400)
+            neighbors = int(neighbors)
+
+        permissions = AccessPermission.get_for_request(request)
         try:
-            location = Locator.load().locate(request.data, permissions=AccessPermission.get_for_request(request))
+            if session:
+                # don't create a session for every scan, only once there is a fix to remember
+                session_key = request.session.session_key
+                locator_session = LocatorSession.load(session_key) if session_key else LocatorSession(None)
+                location = Locator.load().locate_session(request.data, locator_session, permissions=permissions)
+                if locator_session.fixes:
+                    if not session_key:
+                        # empty sessions don't get a cookie
+                        request.session['locator_session'] = True
+                        request.session.save()
+                        locator_session.session_key = request.session.session_key
+                    locator_session.save()
+            elif neighbors is None:
+                location = Locator.load().locate(request.data, permissions=permissions)
+            else:
+                location, accuracy = Locator.load().locate_nearest(request.data, permissions=permissions,
+                                                                   k=neighbors)
         except ValidationError:
             return Response({
                 'errors': (_('Invalid scan data.'),),
             }, status=400)
+        except NotYetRoutable:
+            return Response({
+                'error': routing_errors[NotYetRoutable],
+            })
 
-        return Response({'location': None if location is None else location.serialize(simple_geometry=True)})
+        result = {'location': None if location is None else location.serialize(simple_geometry=True)}
+        if neighbors is not None:
+            result['accuracy'] = accuracy
+        return Response(result)
@@ -0,0 +1,86 @@
+import logging
+import threading
+import time
+
+from django.db import close_old_connections
+
+logger = logging.getLogger('c3nav')
+
+
+class MapUpdateLoaderMixin:
+    """
+    Keeps the instance for the last processed map update loaded.
+    After the first load, a background thread per process watches for new processed map updates,
+    loads them off the request path and swaps them in. Requests keep using the instance they got.
+    Subclasses need to define cached, cache_update and cache_lock and implement load_nocache(update).
+    Subclasses that need the instance of another loader for the same map update (like the locator needs the router)
+    set load_with to that class. It is loaded and swapped in in the same step and kept as loaded_with on the instance.
+    """
+    reload_interval = 2
+    load_duration = None
+    loader_thread = None
+    load_with = None
+    loaded_update = None  # set on instances
+    loaded_with = None  # set on instances
+
+    @classmethod
+    def load(cls):
+        cached = cls.cached
+        if cached is None or cls.loader_thread is None:
+            with cls.cache_lock:
+                if cls.cached is None:
+                    from c3nav.mapdata.models import MapUpdate
+                    cls._load_update(MapUpdate.last_processed_update())
+                cached = cls.cached
+                if cls.loader_thread is None:
+                    cls.loader_thread = threading.Thread(target=cls._loader_thread, daemon=True)
+                    cls.loader_thread.start()
+        return cached
+
+    @classmethod
+    def load_update(cls, update):
+        """
+        get the instance for the given map update, load and swap it in if it is newer than the current one.
+        only to be used by the loader of another class, this never happens on the request path.
+        """
+        with cls.cache_lock:
+            cached = cls.cached
+            if cached is not None and cls.cache_update == update:
+                return cached
+            if cached is not None and cls.cache_update > update:
+                # this class is ahead already, load the instance without swapping it in
+                return cls._load_instance(update)
+            cls._load_update(update)
+            return cls.cached
+
+    @classmethod
+    def _load_instance(cls, update):
+        start = time.perf_counter()
+        loaded_with = None if cls.load_with is None else cls.load_with.load_update(update)
+        instance = cls.load_nocache(update)
+        instance.loaded_update = update
+        instance.loaded_with = loaded_with
+        cls.load_duration = time.perf_counter() - start
+        logger.info('%s for update %s loaded in %.3f s.' % (cls.__name__, update, cls.load_duration))
+        return instance
+
+    @classmethod
+    def _load_update(cls, update):
+        instance = cls._load_instance(update)
+        cls.cached, cls.cache_update = instance, update
+
+    @classmethod
+    def _loader_thread(cls):
+        from c3nav.mapdata.models import MapUpdate
+        while True:
+            time.sleep(cls.reload_interval)
+            try:
+                update = MapUpdate.last_processed_update()
+                if cls.cache_update != update:
+                    with cls.cache_lock:
+                        if cls.cache_update != update:
+                            cls._load_update(update)
+            except Exception:
+                logger.exception('Loading new %s failed, retrying.' % cls.__name__)
+            finally:
+                close_old_connections()
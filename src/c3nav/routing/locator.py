@@ -1,44 +1,112 @@
+import logging
 import operator
 import os
 import pickle
 import re
 import threading
+import time
 from collections import deque, namedtuple
 from functools import reduce
 
 import numpy as np
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
+from django.utils.functional import cached_property
 from django.utils.translation import ugettext_lazy as _
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree
 
-from c3nav.mapdata.models import MapUpdate, Space
+from c3nav.mapdata.models import MapUpdate
+from c3nav.mapdata.models.geometry.space import WifiMeasurement
 from c3nav.mapdata.utils.locations import CustomLocation
+from c3nav.routing.exceptions import NotYetRoutable
+from c3nav.routing.loader import MapUpdateLoaderMixin
 from c3nav.routing.router import Router
 
+logger = logging.getLogger('c3nav')
 
-class Locator:
-    filename = os.path.join(settings.CACHE_ROOT, 'locator')
 
-    def __init__(self, stations, spaces):
+class Locator(MapUpdateLoaderMixin):
+    filename = os.path.join(settings.CACHE_ROOT, 'locator')
+    no_signal = int(-90)**3
+    rebuild_stations_per_point = 16  # initial guess for preallocating
+    min_accuracy = 3  # meters, about the spacing of measurement points, no fix is more precise than that
+
+    def __init__(self, stations, point_xy, point_spaces, space_pks, fingerprints):
+        """
+        :param point_xy: coordinates of all measurement points
+        :param point_spaces: space index of every point
+        :param space_pks: space pk for every space index
+        :param fingerprints: fingerprint matrix (points × stations), only stations that were heard are stored
+        """
         self.stations = stations
-        self.spaces = spaces
+        self.point_xy = point_xy
+        self.point_spaces = point_spaces
+        self.space_pks = space_pks
+        self.fingerprints = fingerprints
+        self.fingerprints.sort_indices()
+
+        self.space_masks = {}
 
     @classmethod
     def rebuild(cls, update):
+        start = time.perf_counter()
         stations = LocatorStations()
-        spaces = {}
-        for space in Space.objects.prefetch_related('wifi_measurements'):
-            new_space = LocatorSpace(
-                LocatorPoint.from_measurement(measurement, stations)
-                for measurement in space.wifi_measurements.all()
-            )
-            if new_space.points:
-                spaces[space.pk] = new_space
-
-        locator = cls(stations, spaces)
+
+        # measurements are streamed, their fingerprints are appended to preallocated arrays.
+        # measurements might be added while streaming, so the arrays are grown if needed.
+        num_points = WifiMeasurement.objects.count()
+        point_xy = np.empty((num_points, 2), dtype=np.float64)
+        point_spaces = np.empty((num_points, ), dtype=np.uint32)
+        point_indptr = np.zeros((num_points+1, ), dtype=np.int64)
+        station_ids = np.empty((num_points*cls.rebuild_stations_per_point, ), dtype=np.uint32)
+        levels = np.empty((num_points*cls.rebuild_stations_per_point, ), dtype=np.int16)
+        space_lookup = {}
+
+        i = 0
+        measurements = WifiMeasurement.objects.only('space', 'geometry', 'data').order_by('space_id', 'pk')
+        for measurement in measurements.iterator():
+            values = LocatorPoint.convert_scans(measurement.data, stations, create=True)
+            if not values:
+                continue
+            if i >= point_spaces.size:
+                point_xy = cls._grow_array(point_xy, i+1)
+                point_spaces = cls._grow_array(point_spaces, i+1)
+                point_indptr = cls._grow_array(point_indptr, i+2)
+            start_entry = point_indptr[i]
+            end_entry = start_entry+len(values)
+            if end_entry > station_ids.size:
+                station_ids = cls._grow_array(station_ids, end_entry)
+                levels = cls._grow_array(levels, end_entry)
+            station_ids[start_entry:end_entry] = tuple(values.keys())
+            levels[start_entry:end_entry] = tuple(values.values())
+            point_indptr[i+1] = end_entry
+            point_xy[i] = (measurement.geometry.x, measurement.geometry.y)
+            point_spaces[i] = space_lookup.setdefault(measurement.space_id, len(space_lookup))
+            i += 1
+
+        num_entries = point_indptr[i]
+        fingerprints = csr_matrix((levels[:num_entries], station_ids[:num_entries], point_indptr[:i+1]),
+                                  shape=(i, len(stations.stations)))
+        space_pks = np.array(sorted(space_lookup.keys(), key=space_lookup.get), dtype=np.uint32)
+
+        locator = cls(stations, point_xy[:i].copy(), point_spaces[:i].copy(), space_pks, fingerprints)
+        stations.build_index(locator.fingerprints, locator.point_spaces, len(space_pks))
         pickle.dump(locator, open(cls.build_filename(update), 'wb'))
+
+        logger.info('Locator rebuilt in %.3f s: %d points, %d stations, %d spaces.' % (
+            time.perf_counter() - start, i, len(stations.stations), len(space_pks)
+        ))
         return locator
 
+    @staticmethod
+    def _grow_array(array, size):
+        # grow along the first axis
+        new_array = np.empty((max(size, len(array)*2), )+array.shape[1:], dtype=array.dtype)
+        new_array[:len(array)] = array
+        return new_array
+
     @classmethod
     def build_filename(cls, update):
         return os.path.join(settings.CACHE_ROOT, 'locator_%s.pickle' % MapUpdate.build_cache_key(*update))
@@ -51,62 +119,248 @@ class Locator:
     cache_update = None
     cache_lock = threading.Lock()
 
-    @classmethod
-    def load(cls):
-        from c3nav.mapdata.models import MapUpdate
-        update = MapUpdate.last_processed_update()
-        if cls.cache_update != update:
-            with cls.cache_lock:
-                cls.cache_update = update
-                cls.cached = cls.load_nocache(update)
-        return cls.cached
+    load_with = Router
+
+    def get_router(self):
+        """
+        get the router for the map update of this locator, it is loaded and swapped in together with it.
+        the space pks and space masks of this locator are only valid for that router's spaces.
+        """
+        if self.loaded_with is not None:
+            return self.loaded_with
+        if self.loaded_update is None:
+            return Router.load()
+        raise NotYetRoutable
+
+    def get_space_mask(self, restrictions):
+        """
+        boolean array of the spaces that are visible with the given restriction set, cached per restriction set
+        """
+        space_mask = self.space_masks.get(restrictions.cache_key)
+        if space_mask is None:
+            space_mask = np.array(tuple(pk not in restrictions.spaces for pk in self.space_pks.tolist()), dtype=bool)
+            self.space_masks[restrictions.cache_key] = space_mask
+        return space_mask
 
     def locate(self, scan, permissions=None):
-        router = Router.load()
-        restrictions = router.get_restrictions(permissions)
+        router = self.get_router()
+        points, scores = self.get_scores(router, scan, permissions)
+        if points is None:
+            return None
 
-        scan = LocatorPoint.clean_scan(scan, ignore_invalid_stations=True)
-        scan_values = LocatorPoint.convert_scan(scan, self.stations, create=False)
-        station_ids = frozenset(scan_values.keys())
+        point = points[np.argmin(scores)]
+        return CustomLocation(router.spaces[int(self.space_pks[self.point_spaces[point]])].level,
+                              float(self.point_xy[point, 0]), float(self.point_xy[point, 1]),
+                              permissions=permissions, icon='my_location')
+
+    def locate_nearest(self, scan, permissions=None, k=4):
+        """
+        locate by interpolating between the k best matching measurement points on the level of the best one.
+        all acceptable points are scored like in locate(), the k best of them are then picked by partitioning.
+        :return: location at the weighted centroid of these points, uncertainty radius in meters
+                 (at least min_accuracy, even if only one point is left)
+        """
+        router = self.get_router()
+        points, scores = self.get_scores(router, scan, permissions)
+        if points is None:
+            return None, None
 
+        if points.size > k:
+            nearest = np.argpartition(scores, k-1)[:k]
+            points, scores = points[nearest], scores[nearest]
+        order = np.argsort(scores, kind='mergesort')
+        points, scores = points[order], scores[order]
+
+        # only interpolate between points on the same level
+        levels = np.array(tuple(router.spaces[int(pk)].level_id
+                                for pk in self.space_pks[self.point_spaces[points]].tolist()))
+        same_level = levels == levels[0]
+        points, scores = points[same_level], scores[same_level]
+
+        # scores are mean squared differences of cubed levels, so weigh by the inverse root
+        weights = 1 / (np.sqrt(scores) + 1)
+        weights /= weights.sum()
+        xy = self.point_xy[points]
+        centroid = (xy * weights.reshape((-1, 1))).sum(axis=0)
+        radius = max(np.sqrt((((xy - centroid) ** 2).sum(axis=1) * weights).sum()), self.min_accuracy)
+
+        location = CustomLocation(router.spaces[int(self.space_pks[self.point_spaces[points[0]]])].level,
+                                  float(centroid[0]), float(centroid[1]), permissions=permissions, icon='my_location')
+        return location, round(float(radius), 2)
+
+    def locate_session(self, scan, session, permissions=None):
+        """
+        locate a client that sends scans continuously. if the session has a recent fix, only the measurement points
+        near it are scored, the search falls back to all points if none of them match well enough.
+        the returned location is smoothed over the recent fixes of the session, which is updated but not saved.
+        if the search falls back to all points or the new fix is outside the radius, the client probably moved
+        somewhere else, so the history is cleared and smoothing starts again from the new fix.
+        """
+        router = self.get_router()
+        scan_values, space_mask = self.prepare_scan(router, scan, permissions)
         if not scan_values:
             return None
 
-        # get visible spaces
-        spaces = tuple((pk, space, station_ids & space.stations_set)
-                       for pk, space in self.spaces.items()
-                       if pk not in restrictions.spaces)
-
-        # get relevant spaces
+        points = None
+        last_fix = session.last_fix
+        if last_fix is not None:
+            candidates = self.get_points_near(router, last_fix.level, last_fix.x, last_fix.y, session.radius)
+            points, scores = self.score_points(scan_values, space_mask, candidates=candidates)
+            if points is not None and scores.min() > max(last_fix.score, 1) * session.max_score_factor:
+                points = None
+
+        fallback = points is None
+        if fallback:
+            points, scores = self.score_points(scan_values, space_mask)
+            if points is None:
+                return None
+
+        best_point = np.argmin(scores)
+        point = points[best_point]
+        level = router.spaces[int(self.space_pks[self.point_spaces[point]])].level
+        x, y = float(self.point_xy[point, 0]), float(self.point_xy[point, 1])
+        if last_fix is not None and (fallback or level.pk != last_fix.level or
+                                     np.hypot(x - last_fix.x, y - last_fix.y) > session.radius):
+            session.clear()
+        session.add_fix(level.pk, x, y, scores[best_point])
+
+        x, y = session.get_smoothed_position()
+        return CustomLocation(level, x, y, permissions=permissions, icon='my_location')
+
+    @cached_property
+    def point_tree(self):
+        return cKDTree(self.point_xy)
+
+    def get_points_near(self, router, level_pk, x, y, radius):
+        """
+        :return: sorted indices of the measurement points on the given level within the given radius
+        """
+        points = np.array(sorted(self.point_tree.query_ball_point((x, y), radius)), dtype=np.uint32)
+        point_spaces = self.space_pks[self.point_spaces[points]]
+        on_level = np.array(tuple(router.spaces[pk].level_id == level_pk for pk in point_spaces.tolist()), dtype=bool)
+        return points[on_level]
+
+    def prepare_scan(self, router, scan, permissions=None):
+        """
+        clean the scan
+        :return: station levels of the scan, mask of the visible spaces
+        """
+        scan = LocatorPoint.clean_scan(scan, ignore_invalid_stations=True)
+        scan_values = LocatorPoint.convert_scan(scan, self.stations, create=False)
+        return scan_values, self.get_space_mask(router.get_restrictions(permissions))
+
+    def get_scores(self, router, scan, permissions=None):
+        """
+        clean the scan and score it against the measurement points
+        :return: point indices, scores (lower is better) or None, None
+        """
+        scan_values, space_mask = self.prepare_scan(router, scan, permissions)
+        if not scan_values:
+            return None, None
+        return self.score_points(scan_values, space_mask)
+
+    def score_points(self, scan_values, space_mask, candidates=None):
+        """
+        score the scan against all measurement points that heard the needed station in one go.
+        the score of a point is the mean squared difference of the cubed levels,
+        over the stations of the scan that were heard anywhere in the point's space.
+        :param candidates: only score these points (sorted indices), optional
+        :return: indices of the acceptable points, their scores
+        """
+        station_ids = tuple(scan_values.keys())
+        values = np.array(tuple(scan_values.values()), dtype=np.int64)
         best_station_id = min(scan_values.items(), key=operator.itemgetter(1))[0]
-        spaces = tuple((pk, space, station_ids)
-                       for pk, space, station_ids in spaces
-                       if station_ids and best_station_id in station_ids)
 
-        if not spaces:
-            return None
+        # get relevant spaces: visible and the needed station was heard there
+        spaces = self.stations.get_spaces(best_station_id)
+        spaces = spaces[space_mask[spaces]]
+        if not spaces.size:
+            return None, None
+
+        # which stations of the scan were heard in each relevant space
+        space_stations = np.column_stack(tuple(np.isin(spaces, self.stations.get_spaces(station_id),
+                                                       assume_unique=True)
+                                               for station_id in station_ids))
+        space_station_count = space_stations.sum(axis=1)
 
         # get good spaces
-        good_spaces = tuple((pk, space, station_ids) for pk, space, station_ids in spaces if len(station_ids) >= 3)
-        if not good_spaces:
-            for station_id in station_ids:
-                scan_values[station_id] = 0
-            good_spaces = spaces
-
-        best_location = None
-        best_score = float('inf')
-
-        for pk, space, station_ids in good_spaces:
-            point, score = space.get_best_point(scan_values, station_ids, needed_station_id=best_station_id)
-            if point is None:
-                continue
-            if score < best_score:
-                location = CustomLocation(router.spaces[pk].level, point.x, point.y,
-                                          permissions=permissions, icon='my_location')
-                best_location = location
-                best_score = score
+        good_spaces = space_station_count >= 3
+        if not good_spaces.any():
+            values[:] = 0
+            good_spaces[:] = True
+
+        # acceptable points heard the needed station and are in a good space
+        points, levels = self.stations.get_points(best_station_id)
+        points = points[levels > -90]
+        if candidates is not None:
+            points = points[np.isin(points, candidates, assume_unique=True)]
+        point_spaces = np.minimum(np.searchsorted(spaces, self.point_spaces[points]), spaces.size-1)
+        acceptable = (spaces[point_spaces] == self.point_spaces[points]) & good_spaces[point_spaces]
+        points, point_spaces = points[acceptable], point_spaces[acceptable]
+        if not points.size:
+            return None, None
+
+        levels = self.fingerprints[points][:, np.array(station_ids, dtype=np.uint32)].toarray().astype(np.int64)**3
+        levels[levels == 0] = self.no_signal
+        scores = (np.sum(((levels-values**3)**2)*space_stations[point_spaces], axis=1) /
+                  space_station_count[point_spaces])
+
+        return points, scores
+
+
+LocatorFix = namedtuple('LocatorFix', ('time', 'level', 'x', 'y', 'score'))
+
 
-        return best_location
+class LocatorSession:
+    """
+    recent fixes of a client, stored in the cache by session key
+    """
+    history_length = 5
+    timeout = 10  # seconds after which fixes are forgotten
+    radius = 15  # meters around the last fix in which to search first
+    max_score_factor = 4  # search everywhere if the best match is that much worse than the last one
+
+    def __init__(self, session_key):
+        self.session_key = session_key
+        self.fixes = deque(maxlen=self.history_length)
+
+    @staticmethod
+    def build_cache_key(session_key):
+        return 'routing:locator:session:%s' % session_key
+
+    @classmethod
+    def load(cls, session_key):
+        session = cache.get(cls.build_cache_key(session_key))
+        if session is None:
+            session = cls(session_key)
+        return session
+
+    def save(self):
+        cache.set(self.build_cache_key(self.session_key), self, self.timeout)
+
+    @property
+    def last_fix(self):
+        if self.fixes and self.fixes[-1].time > time.time() - self.timeout:
+            return self.fixes[-1]
+        return None
+
+    def clear(self):
+        self.fixes.clear()
+
+    def add_fix(self, level, x, y, score):
+        self.fixes.append(LocatorFix(time.time(), level, x, y, float(score)))
+
+    def get_smoothed_position(self):
+        """
+        average of the recent fixes on the level of the last one, the newer the fix, the higher its weight
+        """
+        last_fix = self.fixes[-1]
+        min_time = last_fix.time - self.timeout
+        fixes = tuple(fix for fix in self.fixes if fix.level == last_fix.level and fix.time > min_time)
+        weights = np.arange(1, len(fixes)+1)
+        xy = np.array(tuple((fix.x, fix.y) for fix in fixes))
+        x, y = (xy * weights.reshape((-1, 1))).sum(axis=0) / weights.sum()
+        return float(x), float(y)
 
 
 class LocatorStations:
@@ -114,6 +368,13 @@ class LocatorStations:
         self.stations = []
         self.stations_lookup = {}
 
+        # inverted index, see build_index()
+        self.points_indptr = np.zeros((1, ), dtype=np.int32)
+        self.points = np.array((), dtype=np.uint32)
+        self.levels = np.array((), dtype=np.int16)
+        self.spaces_indptr = np.zeros((1, ), dtype=np.int32)
+        self.spaces = np.array((), dtype=np.uint32)
+
     def get(self, bssid, ssid, frequency, create=False):
         station_id = self.stations_lookup.get((bssid, None), None)
         if station_id is not None:
@@ -126,33 +387,35 @@ class LocatorStations:
             self.stations.append(station)
         return station_id
 
-
-class LocatorSpace:
-    def __init__(self, points):
-        self.points = tuple(points)
-        self.stations_set = reduce(operator.or_, (frozenset(point.values.keys()) for point in self.points), frozenset())
-        self.stations = tuple(self.stations_set)
-        self.stations_lookup = {station_id: i for i, station_id in enumerate(self.stations)}
-
-        self.levels = np.full((len(self.points), len(self.stations)), fill_value=int(-90)**3, dtype=np.int64)
-        for i, point in enumerate(self.points):
-            for station_id, value in point.values.items():
-                self.levels[i][self.stations_lookup[station_id]] = int(value)**3
-
-    def get_best_point(self, scan_values, station_ids, needed_station_id=None):
-        stations = tuple(self.stations_lookup[station_id] for station_id in station_ids)
-        values = np.array(tuple(scan_values[station_id]**3 for station_id in station_ids), dtype=np.int64)
-        acceptable_points = tuple(
-            np.argwhere(self.levels[:, self.stations_lookup[needed_station_id]] > int(-90)**3).ravel()
-        )
-        if not acceptable_points:
-            return None, None
-        scores = np.sum((self.levels[np.array(acceptable_points, dtype=np.uint32).reshape((-1, 1)),
-                                     stations]-values)**2, axis=1) / len(stations)
-
-        best_acceptable_point = np.argmin(scores).ravel()[0]
-        best_point = acceptable_points[best_acceptable_point]
-        return self.points[best_point], scores[best_acceptable_point]
+    def build_index(self, fingerprints, point_spaces, num_spaces):
+        """
+        build the inverted index from station id to the measurement points and spaces that heard it
+        :param fingerprints: fingerprint matrix (points × stations)
+        :param point_spaces: space index of every point
+        """
+        by_station = fingerprints.tocsc()
+        by_station.sort_indices()
+        self.points_indptr, self.points, self.levels = by_station.indptr, by_station.indices, by_station.data
+
+        station_spaces = csr_matrix((np.ones(by_station.nnz, dtype=np.uint8),
+                                     (np.repeat(np.arange(len(self.stations)), np.diff(by_station.indptr)),
+                                      point_spaces[by_station.indices])),
+                                    shape=(len(self.stations), num_spaces))
+        station_spaces.sum_duplicates()
+        self.spaces_indptr, self.spaces = station_spaces.indptr, station_spaces.indices
+
+    def get_points(self, station_id):
+        """
+        :return: sorted indices of the points that heard this station, their levels
+        """
+        points = slice(self.points_indptr[station_id], self.points_indptr[station_id+1])
+        return self.points[points], self.levels[points]
+
+    def get_spaces(self, station_id):
+        """
+        :return: sorted indices of the spaces in which this station was heard
+        """
+        return self.spaces[self.spaces_indptr[station_id]:self.spaces_indptr[station_id+1]]
 
 
 class LocatorPoint(namedtuple('LocatorPoint', ('x', 'y', 'values'))):
@@ -0,0 +1,69 @@
+import random
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.utils.translation import ugettext_lazy as _
+
+from c3nav.routing.locator import Locator
+
+
+class Command(BaseCommand):
+    help = 'benchmark the locator with synthetic scans based on the wifi measurements'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', default=1000, type=int, help=_('number of synthetic scans (default: 1000)'))
+        parser.add_argument('--noise', default=5, type=int, help=_('maximum level noise in dBm (default: 5)'))
+        parser.add_argument('--drop', default=0.2, type=float,
+                            help=_('probability to drop a station from a scan (default: 0.2)'))
+        parser.add_argument('--neighbors', default=None, type=int,
+                            help=_('interpolate between this many measurements (default: only the best one)'))
+        parser.add_argument('--seed', default=0, type=int, help=_('random seed (default: 0)'))
+
+    def handle(self, *args, **options):
+        locator = Locator.load()
+        if not locator.point_xy.size:
+            print('No wifi measurements.')
+            return
+
+        rand = random.Random(options['seed'])
+        num_points = locator.point_xy.shape[0]
+        sources = tuple(rand.randrange(num_points) for i in range(options['count']))
+        scans = tuple(self.build_scan(locator, point, rand, options['noise'], options['drop']) for point in sources)
+
+        print('%d points, %d stations, %d spaces, %d scans' % (num_points, len(locator.stations.stations),
+                                                               len(locator.space_pks), len(scans)))
+
+        permissions = set()
+        if options['neighbors']:
+            def locate(scan):
+                return locator.locate_nearest(scan, permissions=permissions, k=options['neighbors'])[0]
+        else:
+            def locate(scan):
+                return locator.locate(scan, permissions=permissions)
+
+        locate(scans[0])  # load router and restrictions
+        start = time.perf_counter()
+        results = tuple(locate(scan) for scan in scans)
+        duration = time.perf_counter() - start
+
+        errors = tuple(np.hypot(result.x - locator.point_xy[point, 0], result.y - locator.point_xy[point, 1])
+                       for point, result in zip(sources, results) if result is not None)
+        print('%8.3f ms/scan, %d scans located, mean error %.2f m' % (
+            duration * 1000 / len(scans), len(errors), (sum(errors) / len(errors)) if errors else 0
+        ))
+
+    def build_scan(self, locator, point, rand, noise, drop):
+        scan = []
+        fingerprint = locator.fingerprints[point]
+        for station_id, level in zip(fingerprint.indices.tolist(), fingerprint.data.tolist()):
+            if rand.random() < drop:
+                continue
+            station = locator.stations.stations[station_id]
+            scan.append({
+                'bssid': station.bssid,
+                'ssid': station.ssid,
+                'frequency': next(iter(station.frequencies)),
+                'level': min(-1, max(-100, int(level) + rand.randint(-noise, noise))),
+            })
+        return scan
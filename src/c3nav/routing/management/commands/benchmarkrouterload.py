@@ -0,0 +1,55 @@
+import gc
+import os
+import pickle
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.utils.translation import ugettext_lazy as _
+
+from c3nav.mapdata.models import MapUpdate
+from c3nav.routing.router import Router
+
+
+def get_rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+class Command(BaseCommand):
+    help = 'benchmark loading the router snapshot compared to unpickling a fully loaded router'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', default=5, type=int, help=_('number of loads (default: 5)'))
+
+    def handle(self, *args, **options):
+        update = MapUpdate.last_processed_update()
+
+        # the old format: one pickle with everything loaded
+        router = Router.load_nocache(update, lazy=False)
+        router.graph = router.graph.copy()
+        for name in ('edge_distances', 'edge_waytypes', 'edge_rises', 'edge_restrictions'):
+            setattr(router, name, np.array(getattr(router, name)))
+        for name in ('pks', 'xyz', 'spaces'):
+            setattr(router.nodes, name, np.array(getattr(router.nodes, name)))
+        pickled = pickle.dumps(router, protocol=pickle.HIGHEST_PROTOCOL)
+        del router
+
+        print('pickle: %.1f MiB' % (len(pickled) / 1024 / 1024))
+        self.benchmark('pickle', lambda: pickle.loads(pickled), options['count'])
+        self.benchmark('snapshot', lambda: Router.load_nocache(update), options['count'])
+
+    def benchmark(self, name, func, count):
+        durations = []
+        rss = []
+        for i in range(count):
+            gc.collect()
+            rss_before = get_rss()
+            start = time.perf_counter()
+            result = func()
+            durations.append(time.perf_counter() - start)
+            rss.append(get_rss() - rss_before)
+            del result
+        print('%-10s %8.1f ms/load, %8.1f MiB rss/load' % (
+            name, sum(durations) * 1000 / count, sum(rss) / count / 1024 / 1024
+        ))
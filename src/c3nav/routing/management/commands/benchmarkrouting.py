@@ -0,0 +1,56 @@
+import random
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.utils.translation import ugettext_lazy as _
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+from c3nav.routing.models import RouteOptions
+from c3nav.routing.router import Router
+
+
+class Command(BaseCommand):
+    help = 'benchmark the routing engines on random node pairs of the current routing graph'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', default=100, type=int, help=_('number of random routes (default: 100)'))
+        parser.add_argument('--mode', default='fastest', choices=('fastest', 'shortest'),
+                            help=_('routing mode (default: fastest)'))
+        parser.add_argument('--seed', default=0, type=int, help=_('random seed (default: 0)'))
+
+    def handle(self, *args, **options):
+        router = Router.load()
+        restrictions = router.get_restrictions(set())
+        route_options = RouteOptions()
+        route_options['mode'] = options['mode']
+
+        rand = random.Random(options['seed'])
+        pairs = tuple((rand.randrange(len(router.nodes)), rand.randrange(len(router.nodes)))
+                      for i in range(options['count']))
+
+        print('%d nodes, %d edges, %d routes' % (len(router.nodes), router.graph.nnz, len(pairs)))
+
+        weights = router.get_edge_weights(restrictions, route_options)
+        graph = csr_matrix((weights, router.graph.indices, router.graph.indptr), shape=router.graph.shape)
+        start = time.perf_counter()
+        results = tuple(dijkstra(graph, directed=True, indices=origin) for origin, destination in pairs)
+        self.print_result('scipy', time.perf_counter() - start, pairs,
+                          tuple(np.isfinite(distances).sum() for distances in results),
+                          tuple(distances[destination] for (origin, destination), distances in zip(pairs, results)))
+
+        for engine in ('dijkstra', 'astar'):
+            start = time.perf_counter()
+            results = tuple(router.shortest_path(restrictions, route_options, (origin, ), (destination, ),
+                                                 engine=engine)[0]
+                            for origin, destination in pairs)
+            self.print_result(engine, time.perf_counter() - start, pairs,
+                              tuple(np.isfinite(distances).sum() for distances in results),
+                              tuple(distances[destination] for (origin, destination), distances in zip(pairs, results)))
+
+    def print_result(self, engine, duration, pairs, settled, distances):
+        print('%-10s %8.2f ms/route, %10.1f settled nodes/route, %d routes found, total distance %.2f' % (
+            engine, duration * 1000 / len(pairs), sum(settled) / len(pairs),
+            sum(np.isfinite(distances)), sum(d for d in distances if np.isfinite(d))
+        ))
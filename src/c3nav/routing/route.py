@@ -28,7 +28,7 @@ class Route:
         self.origin_xyz = origin_xyz
         self.destination_xyz = destination_xyz
 
-    def serialize(self, locations):
+    def _build_items(self):
         nodes = [[node, None] for node in self.path_nodes]
         if self.origin_addition and any(self.origin_addition):
             nodes.insert(0, (self.origin_addition[0], None))
@@ -67,6 +67,11 @@ class Route:
         distance += destination_distance
         duration += destination_distance * walk_factor
 
+        return items, distance, duration, destination_distance
+
+    def serialize(self, locations, include_items=True):
+        items, distance, duration, destination_distance = self._build_items()
+
         # descriptions for waytypes
         next_item = None
         last_primary_level = None
@@ -165,7 +170,7 @@ class Route:
         options_summary = ', '.join(str(s) for s in options_summary)
 
 
-        return OrderedDict((
+        result = OrderedDict((
             ('origin', describe_location(self.origin, locations)),
             ('destination', describe_location(self.destination, locations)),
             ('distance', round(distance, 2)),
@@ -174,8 +179,10 @@ class Route:
             ('duration_str', duration_str),
             ('summary', summary),
             ('options_summary', options_summary),
-            ('items', tuple(item.serialize(locations=locations) for item in items)),
         ))
+        if include_items:
+            result['items'] = tuple(item.serialize(locations=locations) for item in items)
+        return result
 
 
 class RouteItem:
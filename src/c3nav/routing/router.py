@@ -1,18 +1,16 @@
-import json
+import hashlib
 import operator
 import os
-import pickle
 import threading
-from collections import deque, namedtuple
+from collections import OrderedDict, deque, namedtuple
 from functools import reduce
-from itertools import chain
+from itertools import chain, product
 from typing import Optional
 
 import numpy as np
 from django.conf import settings
-from django.core.cache import cache
 from django.utils.functional import cached_property
-from scipy.sparse.csgraph._shortest_path import shortest_path
+from scipy.sparse import csr_matrix
 from shapely import prepared
 from shapely.geometry import LineString, Point
 from shapely.ops import unary_union
@@ -22,23 +20,58 @@ from c3nav.mapdata.models.geometry.space import POI, CrossDescription, LeaveDesc
 from c3nav.mapdata.utils.geometry import assert_multipolygon, get_rings, good_representative_point
 from c3nav.mapdata.utils.locations import CustomLocation
 from c3nav.routing.exceptions import LocationUnreachable, NoRouteFound, NotYetRoutable
+from c3nav.routing.loader import MapUpdateLoaderMixin
 from c3nav.routing.route import Route
+from c3nav.routing.search import NO_PREDECESSOR, astar, dijkstra
+from c3nav.routing.snapshot import (LazyGeometry, LazyGeometryAttribute, load_lazy_geometries, open_snapshot,
+                                    remove_old_snapshots, save_snapshot)
 
 
-class Router:
+class Router(MapUpdateLoaderMixin):
     filename = os.path.join(settings.CACHE_ROOT, 'router')
+    snapshot_version = 1
+    snapshot_arrays = ('node_pks', 'node_xyz', 'node_spaces', 'graph_data', 'graph_indices', 'graph_indptr',
+                       'edge_distances', 'edge_waytypes', 'edge_rises', 'edge_restrictions')
 
-    def __init__(self, levels, spaces, areas, pois, groups, restrictions, nodes, edges, waytypes, graph):
+    def __init__(self, levels, spaces, areas, pois, groups, restrictions, waytypes, nodes, graph,
+                 edge_distances, edge_waytypes, edge_rises, edge_restrictions):
         self.levels = levels
         self.spaces = spaces
         self.areas = areas
         self.pois = pois
         self.groups = groups
         self.restrictions = restrictions
-        self.nodes = nodes
-        self.edges = edges
         self.waytypes = waytypes
+        self.nodes = nodes
         self.graph = graph
+        self.edge_distances = edge_distances
+        self.edge_waytypes = edge_waytypes
+        self.edge_rises = edge_rises
+        self.edge_restrictions = edge_restrictions
+
+    @cached_property
+    def edges(self):
+        return RouterEdges(self)
+
+    @cached_property
+    def edge_from(self):
+        return np.repeat(np.arange(self.graph.shape[0], dtype=np.uint32), np.diff(self.graph.indptr))
+
+    @cached_property
+    def edge_upwards(self):
+        return (self.edge_rises > 0).astype(np.uint8)
+
+    @cached_property
+    def edge_weights_cache(self):
+        return RouterEdgeWeightsCache()
+
+    @cached_property
+    def node_xyz(self):
+        return self.nodes.xyz
+
+    @cached_property
+    def min_slow_down_factor(self):
+        return min((float(area.slow_down_factor) for area in self.areas.values() if area.nodes), default=1)
 
     @staticmethod
     def get_altitude_in_areas(areas, point):
@@ -213,57 +246,86 @@ class Router:
                                  access_restriction=edge.access_restriction_id) for edge in GraphEdge.objects.all())
         edges = {(edge.from_node, edge.to_node): edge for edge in edges}
 
-        # build graph matrix
-        graph = np.full(shape=(len(nodes), len(nodes)), fill_value=np.inf, dtype=np.float32)
-        for edge in edges.values():
-            index = (edge.from_node, edge.to_node)
-            graph[index] = edge.distance
-            waytype = waytypes[edge.waytype]
-            (waytype.upwards_indices if edge.rise > 0 else waytype.nonupwards_indices).append(index)
-            if edge.access_restriction:
-                restrictions.setdefault(edge.access_restriction, RouterRestriction()).edges.append(index)
+        # build sparse graph, edges are sorted by origin node so the per-edge arrays are aligned to the csr data
+        sorted_edges = sorted(edges.values(), key=lambda edge: (edge.from_node, edge.to_node))
+        edge_from = np.array(tuple(edge.from_node for edge in sorted_edges), dtype=np.uint32)
+        graph = csr_matrix((np.array(tuple(edge.distance for edge in sorted_edges), dtype=np.float32),
+                            np.array(tuple(edge.to_node for edge in sorted_edges), dtype=np.int32),
+                            np.searchsorted(edge_from, np.arange(len(nodes)+1)).astype(np.int32)),
+                           shape=(len(nodes), len(nodes)))
+        edge_distances = np.array(tuple(edge.distance for edge in sorted_edges), dtype=np.float32)
+        edge_waytypes = np.array(tuple(edge.waytype for edge in sorted_edges), dtype=np.uint16)
+        edge_rises = np.array(tuple(edge.rise for edge in sorted_edges), dtype=np.float32)
+        edge_restrictions = np.array(tuple((edge.access_restriction or 0) for edge in sorted_edges), dtype=np.uint32)
 
         # respect slow_down_factor
         for area in areas.values():
             if area.slow_down_factor != 1:
-                area_nodes = np.array(tuple(area.nodes), dtype=np.uint32)
-                graph[area_nodes.reshape((-1, 1)), area_nodes] *= float(area.slow_down_factor)
-
-        # finalize waytype matrixes
-        for waytype in waytypes:
-            waytype.upwards_indices = np.array(waytype.upwards_indices, dtype=np.uint32).reshape((-1, 2))
-            waytype.nonupwards_indices = np.array(waytype.nonupwards_indices, dtype=np.uint32).reshape((-1, 2))
-
-        # finalize restriction edge matrixes
-        for restriction in restrictions.values():
-            restriction.edges = np.array(restriction.edges, dtype=np.uint32).reshape((-1, 2))
+                area_nodes = np.zeros(len(nodes), dtype=bool)
+                area_nodes[np.array(tuple(area.nodes), dtype=np.uint32)] = True
+                graph.data[area_nodes[edge_from] & area_nodes[graph.indices]] *= float(area.slow_down_factor)
+
+        # finalize restriction edge indices
+        for pk in np.unique(edge_restrictions[edge_restrictions != 0]).tolist():
+            restrictions.setdefault(pk, RouterRestriction())
+        for pk, restriction in restrictions.items():
+            restriction.edges = np.argwhere(edge_restrictions == pk).ravel().astype(np.uint32)
+
+        nodes = RouterNodes(
+            pks=np.array(tuple(node.pk for node in nodes), dtype=np.uint32),
+            xyz=np.array(tuple((node.x, node.y, node.altitude) for node in nodes), dtype=np.float64).reshape((-1, 3)),
+            spaces=np.array(tuple(node.space for node in nodes), dtype=np.uint32),
+        )
 
-        router = cls(levels, spaces, areas, pois, groups, restrictions, nodes, edges, waytypes, graph)
-        pickle.dump(router, open(cls.build_filename(update), 'wb'))
+        router = cls(levels, spaces, areas, pois, groups, restrictions, waytypes, nodes, graph,
+                     edge_distances, edge_waytypes, edge_rises, edge_restrictions)
+        router.save(cls.build_dirname(update))
+        # keep the previous snapshot, workers might still be loading it
+        remove_old_snapshots(settings.CACHE_ROOT, 'router_')
         return router
 
+    def save(self, dirname):
+        save_snapshot(dirname, self.snapshot_version, arrays={
+            'node_pks': self.nodes.pks,
+            'node_xyz': self.nodes.xyz,
+            'node_spaces': self.nodes.spaces,
+            'graph_data': self.graph.data,
+            'graph_indices': self.graph.indices,
+            'graph_indptr': self.graph.indptr,
+            'edge_distances': self.edge_distances,
+            'edge_waytypes': self.edge_waytypes,
+            'edge_rises': self.edge_rises,
+            'edge_restrictions': self.edge_restrictions,
+        }, objects={
+            'levels': self.levels,
+            'spaces': self.spaces,
+            'areas': self.areas,
+            'pois': self.pois,
+            'groups': self.groups,
+            'restrictions': self.restrictions,
+            'waytypes': self.waytypes,
+        })
+
     @classmethod
-    def build_filename(cls, update):
-        return os.path.join(settings.CACHE_ROOT, 'router_%s.pickle' % MapUpdate.build_cache_key(*update))
+    def build_dirname(cls, update):
+        return os.path.join(settings.CACHE_ROOT, 'router_%s' % MapUpdate.build_cache_key(*update))
 
     @classmethod
-    def load_nocache(cls, update):
-        return pickle.load(open(cls.build_filename(update), 'rb'))
+    def load_nocache(cls, update, lazy=True):
+        arrays, objects = open_snapshot(cls.build_dirname(update), cls.snapshot_version, cls.snapshot_arrays,
+                                        lazy=lazy)
+        num_nodes = len(arrays['node_pks'])
+        graph = csr_matrix((arrays['graph_data'], arrays['graph_indices'], arrays['graph_indptr']),
+                           shape=(num_nodes, num_nodes))
+        nodes = RouterNodes(pks=arrays['node_pks'], xyz=arrays['node_xyz'], spaces=arrays['node_spaces'])
+        return cls(nodes=nodes, graph=graph, edge_distances=arrays['edge_distances'],
+                   edge_waytypes=arrays['edge_waytypes'], edge_rises=arrays['edge_rises'],
+                   edge_restrictions=arrays['edge_restrictions'], **objects)
 
     cached = None
     cache_update = None
     cache_lock = threading.Lock()
 
-    @classmethod
-    def load(cls):
-        from c3nav.mapdata.models import MapUpdate
-        update = MapUpdate.last_processed_update()
-        if cls.cache_update != update:
-            with cls.cache_lock:
-                cls.cache_update = update
-                cls.cached = cls.load_nocache(update)
-        return cls.cached
-
     def get_locations(self, location, restrictions):
         locations = ()
         if isinstance(location, Level):
@@ -347,65 +409,105 @@ class Router:
         return CustomLocationDescription(space=space, altitude=altitude,
                                          areas=areas, near_area=near_area, near_poi=near_poi)
 
-    def shortest_path(self, restrictions, options):
-        options_key = json.dumps(options.data, separators=(',', '='), sort_keys=True)[1:-1]
-        cache_key = 'router:shortest_path:%s:%s:%s' % (MapUpdate.current_processed_cache_key(),
-                                                       restrictions.cache_key,
-                                                       options_key)
-        result = cache.get(cache_key)
-        if result:
-            distances, predecessors = result
-            return (np.frombuffer(distances, dtype=np.float64).reshape(self.graph.shape),
-                    np.frombuffer(predecessors, dtype=np.int32).reshape(self.graph.shape))
+    def get_waytype_speeds(self, options):
+        self.waytypes[0].speed = 1
+        self.waytypes[0].speed_up = 1
+        self.waytypes[0].extra_seconds = 0
+        self.waytypes[0].walk = True
+
+        speeds = []
+        for waytype in self.waytypes:
+            speed = float(waytype.speed)
+            speed_up = float(waytype.speed_up)
+            if waytype.walk:
+                speed *= options.walk_factor
+                speed_up *= options.walk_factor
+            speeds.append((speed, speed_up))
+        return speeds
+
+    def get_heuristic_scale(self, options):
+        # lower bound for the weight of an edge per meter of straight-line distance
+        scale = min(1, self.min_slow_down_factor)
+        if options['mode'] == 'fastest':
+            scale /= max(max(speeds) for speeds in self.get_waytype_speeds(options))
+        return scale
+
+    @staticmethod
+    def get_options_key(options):
+        # only the options that affect edge weights
+        return (
+            options['mode'],
+            options.walk_factor if options['mode'] == 'fastest' else None,
+            tuple(sorted((name, value) for name, value in options.items()
+                         if name.startswith('waytype_') and value != 'allow')),
+        )
+
+    def get_edge_weights(self, restrictions, options):
+        cache_key = (self.get_options_key(options), restrictions.cache_key)
+        weights = self.edge_weights_cache.get(cache_key)
+        if weights is None:
+            weights = self.build_edge_weights(restrictions, options)
+            weights.flags.writeable = False
+            self.edge_weights_cache.set(cache_key, weights)
+        return weights
 
-        graph = self.graph.copy()
+    def build_edge_weights(self, restrictions, options):
+        weights = self.graph.data.astype(np.float64)
 
         # speeds of waytypes, if relevant
         if options['mode'] == 'fastest':
-            self.waytypes[0].speed = 1
-            self.waytypes[0].speed_up = 1
-            self.waytypes[0].extra_seconds = 0
-            self.waytypes[0].walk = True
-
-            for waytype in self.waytypes:
-                speed = float(waytype.speed)
-                speed_up = float(waytype.speed_up)
-                if waytype.walk:
-                    speed *= options.walk_factor
-                    speed_up *= options.walk_factor
-
-                for indices, dir_speed in ((waytype.nonupwards_indices, speed), (waytype.upwards_indices, speed_up)):
-                    indices = indices.transpose().tolist()
-                    values = graph[indices]
-                    values /= dir_speed
-                    if waytype.extra_seconds:
-                        values += int(waytype.extra_seconds)
-                    graph[indices] = values
+            speeds = np.array(self.get_waytype_speeds(options), dtype=np.float64).reshape((-1, 2))
+            extra_seconds = np.array(tuple(int(waytype.extra_seconds) for waytype in self.waytypes), dtype=np.float64)
+            weights /= speeds[self.edge_waytypes, self.edge_upwards]
+            weights += extra_seconds[self.edge_waytypes]
 
         # avoid waytypes as specified in settings
-        for waytype in self.waytypes[1:]:
+        factors = np.ones((len(self.waytypes), 2), dtype=np.float64)
+        for i, waytype in enumerate(self.waytypes[1:], start=1):
             value = options.get('waytype_%s' % waytype.pk, 'allow')
             if value in ('avoid', 'avoid_up'):
-                graph[waytype.upwards_indices.transpose().tolist()] *= 100000
+                factors[i, 1] = 100000
             if value in ('avoid', 'avoid_down'):
-                graph[waytype.nonupwards_indices.transpose().tolist()] *= 100000
+                factors[i, 0] = 100000
+        if (factors != 1).any():
+            weights *= factors[self.edge_waytypes, self.edge_upwards]
 
         # exclude spaces and edges
         space_nodes = tuple(reduce(operator.or_, (self.spaces[space].nodes for space in restrictions.spaces), set()))
-        graph[space_nodes, :] = np.inf
-        graph[:, space_nodes] = np.inf
-        graph[restrictions.edges.transpose().tolist()] = np.inf
+        if space_nodes:
+            excluded_nodes = np.zeros(len(self.nodes), dtype=bool)
+            excluded_nodes[np.array(space_nodes, dtype=np.uint32)] = True
+            weights[excluded_nodes[self.edge_from] | excluded_nodes[self.graph.indices]] = np.inf
+        weights[restrictions.edges] = np.inf
+
+        return weights
+
+    def shortest_path(self, restrictions, options, origin_nodes, destination_nodes, all_destinations=False,
+                      destination_groups=None, engine=None):
+        if engine is None:
+            engine = settings.ROUTING_ENGINE
+
+        weights = self.get_edge_weights(restrictions, options)
+        if engine == 'astar':
+            return astar(self.graph, weights, origin_nodes, destination_nodes, xyz=self.node_xyz,
+                         heuristic_scale=self.get_heuristic_scale(options), all_destinations=all_destinations,
+                         destination_groups=destination_groups)
+        if engine == 'dijkstra':
+            return dijkstra(self.graph, weights, origin_nodes, destination_nodes, all_destinations=all_destinations,
+                            destination_groups=destination_groups)
+        raise ValueError('Unknown routing engine: %s' % engine)
 
-        distances, predecessors = shortest_path(graph, directed=True, return_predecessors=True)
-        print(distances.dtype, predecessors.dtype)
-        cache.set(cache_key, (distances.astype(np.float64).tobytes(),
-                              predecessors.astype(np.int32).tobytes()), 600)
-        return distances, predecessors
+    @cached_property
+    def restriction_sets(self):
+        return {}
 
     def get_restrictions(self, permissions):
-        return RouterRestrictionSet({
-            pk: restriction for pk, restriction in self.restrictions.items() if pk not in permissions
-        })
+        restriction_ids = frozenset(self.restrictions.keys() - set(permissions or ()))
+        restrictions = self.restriction_sets.get(restriction_ids)
+        if restrictions is None:
+            restrictions = RouterRestrictionSet({pk: self.restrictions[pk] for pk in restriction_ids})
+            self.restriction_sets[restriction_ids] = restrictions
+        return restrictions
 
     def get_route(self, origin, destination, permissions, options):
         restrictions = self.get_restrictions(permissions)
@@ -414,33 +516,157 @@ class Router:
         origins = self.get_locations(origin, restrictions)
         destinations = self.get_locations(destination, restrictions)
 
-        # calculate shortest path matrix
-        distances, predecessors = self.shortest_path(restrictions, options=options)
+        # run shortest path search from our origins until the nearest destination is reached
+        distances, predecessors = self.shortest_path(restrictions, options,
+                                                     origin_nodes=origins.nodes, destination_nodes=destinations.nodes)
+
+        return self.build_route(origins, destinations, distances, predecessors, options)
+
+    def get_routes(self, pairs, permissions, options, summarize=False):
+        """
+        get routes for many (origin, destination) pairs sharing the same permissions and options.
+        runs one search per distinct origin, until the nearest node of each of its destinations is reached.
+        :param summarize: only get distance and duration of each route, see summarize_route()
+        :return: a list with a Route (or a (distance, duration) tuple) or the routing exception for each pair
+        """
+        restrictions = self.get_restrictions(permissions)
+
+        router_locations = {}
+
+        def get_locations(location):
+            result = router_locations.get(location)
+            if result is None:
+                try:
+                    result = self.get_locations(location, restrictions)
+                except (NotYetRoutable, LocationUnreachable) as e:
+                    result = e
+                router_locations[location] = result
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        pairs_by_origin = OrderedDict()
+        for i, (origin, destination) in enumerate(pairs):
+            pairs_by_origin.setdefault(origin, []).append(i)
+
+        results = [None] * len(pairs)
+        for origin, indices in pairs_by_origin.items():
+            try:
+                origins = get_locations(origin)
+            except (NotYetRoutable, LocationUnreachable) as e:
+                for i in indices:
+                    results[i] = e
+                continue
+
+            destinations = OrderedDict()
+            for i in indices:
+                try:
+                    destinations[i] = get_locations(pairs[i][1])
+                except (NotYetRoutable, LocationUnreachable) as e:
+                    results[i] = e
+            if not destinations:
+                continue
 
-        # find shortest path for our origins and destinations
-        origin_nodes = np.array(tuple(origins.nodes))
-        destination_nodes = np.array(tuple(destinations.nodes))
-        origin_node, destination_node = np.unravel_index(
-            distances[origin_nodes.reshape((-1, 1)), destination_nodes].argmin(),
-            (len(origin_nodes), len(destination_nodes))
+            destination_groups = tuple(location.nodes for location in destinations.values())
+            distances, predecessors = self.shortest_path(restrictions, options, origin_nodes=origins.nodes,
+                                                         destination_nodes=reduce(operator.or_, destination_groups),
+                                                         all_destinations=True, destination_groups=destination_groups)
+
+            build_route = self.summarize_route if summarize else self.build_route
+            for i, location in destinations.items():
+                try:
+                    results[i] = build_route(origins, location, distances, predecessors, options)
+                except NoRouteFound as e:
+                    results[i] = e
+
+        return results
+
+    def get_matrix(self, origins, destinations, permissions, options):
+        """
+        get distance and duration from every origin to every destination, running one search per origin.
+        :return: a list of rows with a (distance, duration) tuple or None if there is no route for each destination
+        """
+        if not destinations:
+            return tuple(() for origin in origins)
+        results = self.get_routes(tuple(product(origins, destinations)), permissions, options, summarize=True)
+        results = tuple((None if isinstance(result, Exception) else result) for result in results)
+        return tuple(results[i:i+len(destinations)] for i in range(0, len(results), len(destinations)))
+
+    def build_route(self, origins, destinations, distances, predecessors, options):
+        (origin, destination, path_nodes,
+         origin_addition, destination_addition, origin_xyz, destination_xyz) = self.find_route(
+            origins, destinations, distances, predecessors
         )
-        origin_node = origin_nodes[origin_node]
-        destination_node = destination_nodes[destination_node]
+        return Route(self, origin, destination, path_nodes, options,
+                     origin_addition, destination_addition, origin_xyz, destination_xyz)
 
-        if distances[origin_node, destination_node] == np.inf:
+    def summarize_route(self, origins, destinations, distances, predecessors, options):
+        """
+        distance and duration of the route, summed directly over the edges of the path without building it
+        """
+        (origin, destination, path_nodes,
+         origin_addition, destination_addition, origin_xyz, destination_xyz) = self.find_route(
+            origins, destinations, distances, predecessors
+        )
+        walk_factor = options.walk_factor
+
+        # edges along the path
+        graph = self.graph
+        edges = np.empty((len(path_nodes)-1, ), dtype=np.int64)
+        for i, (from_node, to_node) in enumerate(zip(path_nodes[:-1], path_nodes[1:])):
+            start, end = graph.indptr[from_node], graph.indptr[from_node+1]
+            edges[i] = start + np.searchsorted(graph.indices[start:end], to_node)
+
+        speeds = np.array(tuple(((float(waytype.speed), float(waytype.speed_up)) if waytype.src else (1, 1))
+                                for waytype in self.waytypes), dtype=np.float64) * walk_factor
+        extra_seconds = np.array(tuple((float(waytype.extra_seconds) if waytype.src else 0)
+                                       for waytype in self.waytypes), dtype=np.float64)
+        edge_waytypes = self.edge_waytypes[edges]
+        edge_distances = self.edge_distances[edges].astype(np.float64)
+        distance = float(edge_distances.sum())
+        duration = float((edge_distances / speeds[edge_waytypes, self.edge_upwards[edges]] +
+                          extra_seconds[edge_waytypes]).sum())
+
+        first_xyz, last_xyz = self.node_xyz[path_nodes[0]], self.node_xyz[path_nodes[-1]]
+        for addition in (origin_addition, destination_addition):
+            if addition and any(addition):
+                node, edge = addition
+                distance += edge.distance
+                duration += self.waytypes[edge.waytype].get_duration(edge, walk_factor)
+                if addition is origin_addition:
+                    first_xyz = node.xyz
+                else:
+                    last_xyz = node.xyz
+
+        for xyz, location_xyz in ((first_xyz, origin_xyz), (last_xyz, destination_xyz)):
+            if location_xyz is not None:
+                location_distance = float(np.linalg.norm(xyz - location_xyz))
+                distance += location_distance
+                duration += location_distance * walk_factor
+
+        return round(distance, 2), round(duration)
+
+    def find_route(self, origins, destinations, distances, predecessors):
+        """
+        get the path to the nearest destination node from the search result
+        :return: origin, destination, path nodes, origin addition, destination addition, origin xyz, destination xyz
+        """
+        destination_nodes = np.array(tuple(destinations.nodes), dtype=np.uint32)
+        destination_node = int(destination_nodes[distances[destination_nodes].argmin()])
+
+        if distances[destination_node] == np.inf:
             raise NoRouteFound
 
-        # get best origin and destination
-        origin = origins.get_location_for_node(origin_node)
-        destination = destinations.get_location_for_node(destination_node)
-
         # recreate path
         path_nodes = deque((destination_node, ))
-        last_node = destination_node
-        while last_node != origin_node:
-            last_node = predecessors[origin_node, last_node]
-            path_nodes.appendleft(last_node)
+        while predecessors[path_nodes[0]] != NO_PREDECESSOR:
+            path_nodes.appendleft(int(predecessors[path_nodes[0]]))
         path_nodes = tuple(path_nodes)
+        origin_node = path_nodes[0]
+
+        # get best origin and destination
+        origin = origins.get_location_for_node(origin_node)
+        destination = destinations.get_location_for_node(destination_node)
 
         origin_addition = origin.nodes_addition.get(origin_node)
         destination_addition = destination.nodes_addition.get(destination_node)
@@ -449,8 +675,7 @@ class Router:
         origin_xyz = origin.xyz if isinstance(origin, RouterPoint) else None
         destination_xyz = destination.xyz if isinstance(destination, RouterPoint) else None
 
-        return Route(self, origin, destination, path_nodes, options,
-                     origin_addition, destination_addition, origin_xyz, destination_xyz)
+        return origin, destination, path_nodes, origin_addition, destination_addition, origin_xyz, destination_xyz
 
 
 CustomLocationDescription = namedtuple('CustomLocationDescription', ('space', 'altitude',
@@ -465,7 +690,7 @@ class BaseRouterProxy:
 
     @cached_property
     def geometry_prep(self):
-        return prepared.prep(self.src.geometry)
+        return prepared.prep(self.geometry)
 
     def __getstate__(self):
         result = self.__dict__.copy()
@@ -475,7 +700,11 @@ class BaseRouterProxy:
     def __getattr__(self, name):
         if name == '__setstate__':
             raise AttributeError
-        return getattr(self.src, name)
+        value = getattr(self.src, name)
+        if isinstance(value, LazyGeometry) or callable(value):
+            load_lazy_geometries(self.src)
+            value = getattr(self.src, name)
+        return value
 
 
 class RouterLevel(BaseRouterProxy):
@@ -544,6 +773,9 @@ class RouterPoint(BaseRouterProxy):
 
 
 class RouterAltitudeArea:
+    geometry = LazyGeometryAttribute('geometry')
+    clear_geometry = LazyGeometryAttribute('clear_geometry')
+
     def __init__(self, geometry, clear_geometry, altitude, altitude2, point1, point2):
         self.geometry = geometry
         self.clear_geometry = clear_geometry
@@ -614,6 +846,48 @@ class RouterNode:
         return np.array((self.x, self.y, self.altitude))
 
 
+class RouterNodes:
+    """
+    nodes of the routing graph, stored as arrays. RouterNode objects are created on access.
+    """
+    def __init__(self, pks, xyz, spaces):
+        self.pks = pks
+        self.xyz = xyz
+        self.spaces = spaces
+
+    def __len__(self):
+        return len(self.pks)
+
+    def __getitem__(self, i):
+        x, y, altitude = self.xyz[i].tolist()
+        return RouterNode(int(i), int(self.pks[i]), x, y, int(self.spaces[i]),
+                          altitude=None if np.isnan(altitude) else altitude)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+class RouterEdges:
+    """
+    edges of the routing graph, looked up by (from_node, to_node). RouterEdge objects are created on access.
+    """
+    def __init__(self, router):
+        self.router = router
+
+    def __getitem__(self, key):
+        from_node, to_node = key
+        graph = self.router.graph
+        start, end = graph.indptr[from_node], graph.indptr[from_node+1]
+        i = start + np.searchsorted(graph.indices[start:end], to_node)
+        if i >= end or graph.indices[i] != to_node:
+            raise KeyError(key)
+        rise = float(self.router.edge_rises[i])
+        return RouterEdge(from_node=self.router.nodes[from_node], to_node=self.router.nodes[to_node],
+                          waytype=int(self.router.edge_waytypes[i]),
+                          access_restriction=int(self.router.edge_restrictions[i]) or None,
+                          rise=None if np.isnan(rise) else rise, distance=float(self.router.edge_distances[i]))
+
+
 class RouterEdge:
     def __init__(self, from_node, to_node, waytype, access_restriction=None, rise=None, distance=None):
         self.from_node = from_node.i
@@ -632,8 +906,6 @@ class RouterEdge:
 class RouterWayType:
     def __init__(self, waytype):
         self.src = waytype
-        self.upwards_indices = deque()
-        self.nonupwards_indices = deque()
 
     def __getattr__(self, name):
         if name == '__setstate__':
@@ -664,10 +936,39 @@ class RouterLocation:
         return None
 
 
+class RouterEdgeWeightsCache:
+    """
+    in-process lru cache for edge weight vectors, bounded by number of entries and total size
+    """
+    max_entries = 32
+    max_bytes = 128*1024*1024
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            weights = self.entries.get(key)
+            if weights is not None:
+                self.entries.move_to_end(key)
+            return weights
+
+    def set(self, key, weights):
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = weights
+            self.nbytes += weights.nbytes
+            while len(self.entries) > 1 and (len(self.entries) > self.max_entries or self.nbytes > self.max_bytes):
+                self.nbytes -= self.entries.popitem(last=False)[1].nbytes
+
+
 class RouterRestriction:
     def __init__(self, spaces=None):
         self.spaces = spaces if spaces else set()
-        self.edges = deque()
+        self.edges = np.array((), dtype=np.uint32)
 
 
 class RouterRestrictionSet:
@@ -681,13 +982,14 @@ class RouterRestrictionSet:
     @cached_property
     def edges(self):
         if not self.restrictions:
-            return np.array((), dtype=np.uint32).reshape((-1, 2))
-        return np.vstack(tuple(restriction.edges for restriction in self.restrictions.values()))
+            return np.array((), dtype=np.uint32)
+        return np.hstack(tuple(restriction.edges for restriction in self.restrictions.values()))
 
     @cached_property
     def cache_key(self):
-        return '%s_%s' % ('-'.join(str(i) for i in self.spaces),
-                          '-'.join(str(i) for i in self.edges.flatten().tolist()))
+        # identified by the unpermitted access restrictions, hashed to always be short enough for any cache
+        restriction_ids = '-'.join(str(pk) for pk in sorted(self.restrictions.keys()))
+        return hashlib.sha1(restriction_ids.encode()).hexdigest()
 
     def __contains__(self, pk):
         return pk in self.restrictions
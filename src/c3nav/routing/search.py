@@ -0,0 +1,98 @@
+import heapq
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+NO_PREDECESSOR = -9999  # same as scipy.sparse.csgraph
+
+
+def dijkstra(graph, weights, origins, destinations, all_destinations=True, destination_groups=None):
+    """
+    multi-source dijkstra over a csr graph, stops as soon as the destinations are settled
+    :param graph: a csr_matrix, only its structure is used
+    :param weights: edge weights, aligned to graph.data
+    :param origins: origin node indices, all of them start at distance 0
+    :param destinations: destination node indices
+    :param all_destinations: wait for all destinations to be settled, otherwise stop at the nearest one
+    :param destination_groups: sets of destination nodes, if given, stop as soon as every group has a settled node,
+                               which is its nearest one
+    :return: 1-D distances and predecessors arrays, nodes that were not settled have an infinite distance
+    """
+    return _search(graph, weights, origins, destinations, all_destinations, destination_groups)
+
+
+def astar(graph, weights, origins, destinations, xyz, heuristic_scale=1, all_destinations=True,
+          destination_groups=None):
+    """
+    multi-source a* over a csr graph, using the straight-line distance to the nearest destination as heuristic
+    :param xyz: node coordinates as an array of shape (num_nodes, 3)
+    :param heuristic_scale: lower bound for the weight of an edge per meter, keeps the heuristic admissible
+    other parameters and return value: see dijkstra()
+    """
+    destination_tree = cKDTree(xyz[np.array(tuple(destinations), dtype=np.uint32)])
+
+    def heuristic(node):
+        return destination_tree.query(xyz[node])[0] * heuristic_scale
+
+    return _search(graph, weights, origins, destinations, all_destinations, destination_groups, heuristic=heuristic)
+
+
+def _search(graph, weights, origins, destinations, all_destinations, destination_groups=None, heuristic=None):
+    indptr, indices = graph.indptr, graph.indices
+
+    distances = {node: 0 for node in origins}
+    predecessors = {}
+    estimates = {}
+    queue = [((heuristic(node) if heuristic else 0), 0, node) for node in distances.keys()]
+    heapq.heapify(queue)
+
+    settled = {}
+    remaining = set(destinations)
+    node_groups = {}
+    if destination_groups is not None:
+        for i, group in enumerate(destination_groups):
+            for node in group:
+                node_groups.setdefault(node, []).append(i)
+    remaining_groups = set(range(len(destination_groups or ())))
+    while queue and remaining:
+        priority, distance, node = heapq.heappop(queue)
+        if node in settled:
+            continue
+        settled[node] = distance
+
+        if node in remaining:
+            remaining.discard(node)
+            if not all_destinations:
+                break
+            if destination_groups is not None:
+                remaining_groups.difference_update(node_groups.get(node, ()))
+                if not remaining_groups:
+                    break
+
+        start, end = indptr[node], indptr[node+1]
+        for neighbor, weight in zip(indices[start:end].tolist(), weights[start:end].tolist()):
+            new_distance = distance + weight
+            if new_distance < distances.get(neighbor, np.inf):
+                distances[neighbor] = new_distance
+                predecessors[neighbor] = node
+                if heuristic is None:
+                    priority = new_distance
+                else:
+                    estimate = estimates.get(neighbor)
+                    if estimate is None:
+                        estimate = heuristic(neighbor)
+                        estimates[neighbor] = estimate
+                    priority = new_distance + estimate
+                heapq.heappush(queue, (priority, new_distance, neighbor))
+
+    return _build_result(graph.shape[0], settled, predecessors)
+
+
+def _build_result(num_nodes, settled, predecessors):
+    distances = np.full(num_nodes, fill_value=np.inf, dtype=np.float64)
+    result_predecessors = np.full(num_nodes, fill_value=NO_PREDECESSOR, dtype=np.int32)
+    if settled:
+        nodes = np.fromiter(settled.keys(), dtype=np.int32, count=len(settled))
+        distances[nodes] = np.fromiter(settled.values(), dtype=np.float64, count=len(settled))
+        result_predecessors[nodes] = tuple(predecessors.get(node, NO_PREDECESSOR) for node in settled.keys())
+    return distances, result_predecessors
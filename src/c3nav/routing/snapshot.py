@@ -0,0 +1,175 @@
+import os
+import pickle
+import re
+import shutil
+import time
+
+import numpy as np
+from shapely import wkb
+from shapely.geometry import Point
+from shapely.geometry.base import BaseGeometry
+
+
+class SnapshotVersionMismatch(Exception):
+    pass
+
+
+def save_snapshot(dirname, version, arrays, objects):
+    """
+    save a snapshot into a new versioned directory and atomically point a symlink at dirname to it.
+    processes that are opening the previous version at the same time keep reading a complete snapshot.
+    numeric data is saved as .npy files, so it can be opened with mmap and shared between processes.
+    geometries inside objects are saved as wkb into one flat file and referenced by index from the pickle.
+    :param dirname: target path
+    :param version: snapshot format version
+    :param arrays: dictionary of numpy arrays
+    :param objects: any picklable object
+    """
+    version_dirname = '%s.%d' % (dirname, time.time()*1000000)
+    os.mkdir(version_dirname)
+
+    for name, array in arrays.items():
+        np.save(os.path.join(version_dirname, name+'.npy'), np.ascontiguousarray(array))
+
+    geometries = []
+    with open(os.path.join(version_dirname, 'objects.pickle'), 'wb') as f:
+        SnapshotPickler(f, geometries, protocol=pickle.HIGHEST_PROTOCOL).dump(objects)
+
+    with open(os.path.join(version_dirname, 'geometries.wkb'), 'wb') as f:
+        f.write(b''.join(geometries))
+    np.save(os.path.join(version_dirname, 'geometries.npy'),
+            np.cumsum([0]+[len(geometry) for geometry in geometries], dtype=np.int64))
+
+    with open(os.path.join(version_dirname, 'version'), 'w') as f:
+        f.write(str(version))
+
+    if os.path.isdir(dirname) and not os.path.islink(dirname):
+        # snapshot from before they were versioned
+        shutil.rmtree(dirname)
+    tmp_link = dirname+'.tmp'
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(os.path.basename(version_dirname), tmp_link)
+    os.replace(tmp_link, dirname)
+
+
+def remove_old_snapshots(dirname, prefix, keep=2):
+    """
+    remove all but the newest snapshot versions whose name starts with the given prefix, and the links to them.
+    :param dirname: directory that contains the snapshots
+    :param keep: number of versions to keep, the current one and the previous one by default
+    """
+    versions = []
+    for filename in os.listdir(dirname):
+        match = snapshot_version_regex.match(filename)
+        if match and filename.startswith(prefix) and not os.path.islink(os.path.join(dirname, filename)):
+            versions.append((int(match.group(1)), filename))
+    versions.sort()
+
+    for i, filename in versions[:-keep]:
+        shutil.rmtree(os.path.join(dirname, filename), ignore_errors=True)
+
+    for filename in os.listdir(dirname):
+        path = os.path.join(dirname, filename)
+        if filename.startswith(prefix) and os.path.islink(path) and not os.path.exists(path):
+            os.remove(path)
+
+
+snapshot_version_regex = re.compile(r'^.+\.(\d+)$')
+
+
+def open_snapshot(dirname, version, array_names, lazy=True):
+    """
+    open a snapshot
+    :param array_names: names of the arrays to open, they are opened read-only with mmap
+    :param lazy: leave geometries as LazyGeometry placeholders until they are needed
+    :return: dictionary of arrays, unpickled objects
+    """
+    # resolve the link once, so all files are from the same version even if a new one is saved meanwhile
+    dirname = os.path.realpath(dirname)
+    with open(os.path.join(dirname, 'version')) as f:
+        snapshot_version = int(f.read())
+    if snapshot_version != version:
+        raise SnapshotVersionMismatch('Snapshot version is %d, but %d is needed.' % (snapshot_version, version))
+
+    arrays = {name: np.load(os.path.join(dirname, name+'.npy'), mmap_mode='r') for name in array_names}
+
+    store = GeometryStore(os.path.join(dirname, 'geometries.wkb'), np.load(os.path.join(dirname, 'geometries.npy')))
+    with open(os.path.join(dirname, 'objects.pickle'), 'rb') as f:
+        objects = SnapshotUnpickler(f, store, lazy=lazy).load()
+
+    return arrays, objects
+
+
+class SnapshotPickler(pickle.Pickler):
+    def __init__(self, file, geometries, **kwargs):
+        super().__init__(file, **kwargs)
+        self.geometries = geometries
+        self.geometries_lookup = {}
+
+    def persistent_id(self, obj):
+        # points are small, everything else is worth loading lazily
+        if isinstance(obj, BaseGeometry) and not isinstance(obj, Point):
+            i = self.geometries_lookup.get(id(obj))
+            if i is None:
+                i = len(self.geometries)
+                self.geometries_lookup[id(obj)] = i
+                self.geometries.append(obj.wkb)
+            return i
+        return None
+
+
+class SnapshotUnpickler(pickle.Unpickler):
+    def __init__(self, file, store, lazy=True):
+        super().__init__(file)
+        self.store = store
+        self.lazy = lazy
+
+    def persistent_load(self, pid):
+        return LazyGeometry(self.store, pid) if self.lazy else self.store.load(pid)
+
+
+class GeometryStore:
+    def __init__(self, filename, offsets):
+        self.offsets = offsets
+        self.data = np.memmap(filename, dtype=np.uint8, mode='r') if offsets[-1] else b''
+
+    def load(self, i):
+        return wkb.loads(bytes(self.data[self.offsets[i]:self.offsets[i+1]]))
+
+
+class LazyGeometry:
+    __slots__ = ('store', 'i')
+
+    def __init__(self, store, i):
+        self.store = store
+        self.i = i
+
+    def load(self):
+        return self.store.load(self.i)
+
+
+class LazyGeometryAttribute:
+    """
+    descriptor for a geometry attribute that might contain a LazyGeometry, which is loaded on first access
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = instance.__dict__[self.name]
+        if isinstance(value, LazyGeometry):
+            value = value.load()
+            instance.__dict__[self.name] = value
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.name] = value
+
+
+def load_lazy_geometries(obj):
+    for name, value in tuple(obj.__dict__.items()):
+        if isinstance(value, LazyGeometry):
+            obj.__dict__[name] = value.load()
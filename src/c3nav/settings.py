@@ -77,10 +77,21 @@ DEBUG = config.getboolean('django', 'debug', fallback=debug_fallback)
 RENDER_SCALE = float(config.get('c3nav', 'render_scale', fallback=20.0))
 IMAGE_RENDERER = config.get('c3nav', 'image_renderer', fallback='svg')
 SVG_RENDERER = config.get('c3nav', 'svg_renderer', fallback='rsvg-convert')
+ROUTING_ENGINE = config.get('c3nav', 'routing_engine', fallback='dijkstra')
 
 CACHE_TILES = config.get('c3nav', 'cache_tiles', fallback=not DEBUG)
 CACHE_RESOLUTION = config.get('c3nav', 'cache_resolution', fallback=4)
 
+# render tiles in blocks of n×n tiles and put all of them into the tile cache, only used if tiles are cached
+METATILE_SIZE = int(config.get('c3nav', 'metatile_size', fallback=1))
+
+# zoom levels and access permission sets (space-separated, e.g. "0 2,3") to pre-render after map updates
+TILE_WARM_ZOOMS = tuple(int(i) for i in config.get('c3nav', 'tile_warm_zooms', fallback='').split())
+TILE_WARM_PERMISSIONS = tuple(
+    frozenset(int(i) for i in value.split(',') if i) - set([0])
+    for value in config.get('c3nav', 'tile_warm_permissions', fallback='0').split()
+)
+
 INITIAL_LEVEL = config.get('c3nav', 'initial_level', fallback=None)
 INITIAL_BOUNDS = config.get('c3nav', 'initial_bounds', fallback='').split(' ')
 
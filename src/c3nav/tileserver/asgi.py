@@ -0,0 +1,240 @@
+import asyncio
+import logging
+import os
+from io import BytesIO
+
+import aiohttp
+import aiomcache
+
+from c3nav.mapdata.utils.cache import CachePackage, CachePackageBaseMismatch
+from c3nav.tileserver.base import BaseTileServer
+from c3nav.tileserver.singleflight import AsyncSingleFlight
+
+logging.basicConfig(level=logging.DEBUG if os.environ.get('C3NAV_DEBUG') else logging.INFO,
+                    format='[%(asctime)s] [%(process)s] [%(levelname)s] %(name)s: %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S %z')
+logger = logging.getLogger('c3nav')
+
+
+class AsyncTileServer(BaseTileServer):
+    """
+    asgi variant of the tile server. upstream requests and memcached access don't block,
+    so one process can serve lots of concurrent tile requests while tiles are being rendered upstream.
+    every process loads the cache package itself and keeps it up to date in a background task.
+    run it with any asgi server, e.g. uvicorn c3nav.tileserver.asgi:application
+    """
+    def __init__(self):
+        super().__init__()
+        self.memcached_pool_size = int(os.environ.get('C3NAV_MEMCACHED_POOL_SIZE', 10))
+        self.session = None
+        self.cache = None
+        self.startup_lock = None
+        self.started = False
+        self.single_flight = AsyncSingleFlight()
+
+    async def startup(self):
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.http_pool_size),
+                                             conn_timeout=self.http_timeout[0], read_timeout=self.http_timeout[1])
+        self.cache = aiomcache.Client('127.0.0.1', pool_size=self.memcached_pool_size)
+
+        wait = 1
+        while True:
+            success = await self.load_cache_package()
+            if success:
+                logger.info('Cache package successfully loaded.')
+                break
+            logger.info('Retrying after %s seconds...' % wait)
+            await asyncio.sleep(wait)
+            wait = min(10, wait*2)
+
+        asyncio.ensure_future(self.update_cache_package_task())
+
+    async def shutdown(self):
+        await self.session.close()
+        await self.cache.close()
+
+    async def ensure_started(self):
+        # servers without lifespan support start us on the first request
+        # the session is created before the cache package is loaded, so it doesn't tell whether we are started.
+        if self.started:
+            return
+        if self.startup_lock is None:
+            self.startup_lock = asyncio.Lock()
+        async with self.startup_lock:
+            if not self.started:
+                await self.startup()
+                self.started = True
+
+    async def update_cache_package_task(self):
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            await self.load_cache_package()
+
+    async def load_cache_package(self):
+        base = self.cache_package
+        while True:
+            logger.debug('Downloading cache package from upstream...')
+            try:
+                headers = self.auth_headers.copy()
+                if self.cache_package_etag is not None and base is not None:
+                    headers['If-None-Match'] = self.cache_package_etag
+                async with self.session.get(self.cache_package_url, params=self.get_cache_package_params(base),
+                                            headers=headers) as r:
+                    if r.status == 403:
+                        logger.error('Rejected cache package download with Error 403. '
+                                     'Tile secret is probably incorrect.')
+                        return False
+
+                    if r.status == 304:
+                        if self.cache_package is not None:
+                            logger.debug('Not modified.')
+                            return True
+                        logger.error('Unexpected not modified.')
+                        return False
+
+                    r.raise_for_status()
+                    content = await r.read()
+                    etag = r.headers.get('ETag', None)
+            except Exception as e:
+                logger.error('Cache package download failed: %s' % e)
+                return False
+
+            logger.debug('Recieving and loading new cache package...')
+
+            try:
+                # parsing is cpu bound, don't block the event loop
+                loop = asyncio.get_event_loop()
+                self.cache_package = await loop.run_in_executor(
+                    None, lambda: CachePackage.read_delta(BytesIO(content), base=base)
+                )
+                self.cache_package_etag = etag
+            except CachePackageBaseMismatch as e:
+                logger.warning('%s Downloading the full cache package.' % e)
+                base = None
+                continue
+            except Exception as e:
+                logger.error('Cache package parsing failed: %s' % e)
+                return False
+            return True
+
+    async def cache_get(self, key):
+        try:
+            return await self.cache.get(key.encode())
+        except Exception as e:
+            logger.warning('memcached error in cache_get(): %s' % e)
+            return None
+
+    async def cache_set(self, key, value):
+        try:
+            await self.cache.set(key.encode(), value)
+        except Exception as e:
+            logger.warning('memcached error in cache_set(): %s' % e)
+
+    async def cache_delete(self, key):
+        try:
+            await self.cache.delete(key.encode())
+        except Exception as e:
+            logger.warning('memcached error in cache_delete(): %s' % e)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+
+        if scope['type'] != 'http':
+            return
+
+        await self.ensure_started()
+
+        headers = {name.decode('latin1').lower(): value.decode('latin1') for name, value in scope['headers']}
+        status, headers, body = await self.get_response(scope['path'], headers)
+        await send({
+            'type': 'http.response.start',
+            'status': int(status.split(' ', 1)[0]),
+            'headers': [(name.lower().encode(), value.encode()) for name, value in headers],
+        })
+        await send({
+            'type': 'http.response.body',
+            'body': body,
+        })
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.ensure_started()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.session is not None:
+                    await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def get_response(self, path_info, headers):
+        response, tile = self.get_tile_request(self.cache_package, path_info,
+                                               cookie=headers.get('cookie', None),
+                                               if_none_match=headers.get('if-none-match'))
+        if response is not None:
+            return response
+
+        cached_result = await self.cache_get(tile.cache_key)
+        if cached_result is not None:
+            return self.deliver_tile(tile.etag, cached_result)
+
+        if self.disk_cache is not None:
+            data = await asyncio.get_event_loop().run_in_executor(None, self.disk_cache.get, tile.etag)
+            if data is not None:
+                # put it back into memcached, so the next request does not have to read it from disk
+                await self.cache_set(tile.cache_key, data)
+                return self.deliver_tile(tile.etag, data)
+
+        return await self.single_flight.do(tile.cache_key, lambda: self.fetch_tile(tile))
+
+    async def fetch_tile(self, tile):
+        """
+        get the tile from upstream, unless another process is already doing that. then wait for its result.
+        """
+        lock_key = self.get_tile_lock_key(tile)
+        try:
+            locked = await self.cache.add(lock_key.encode(), b'1', exptime=self.tile_lock_timeout)
+        except Exception as e:
+            logger.warning('memcached error in fetch_tile(): %s' % e)
+            locked = True
+
+        if not locked:
+            data = await self.wait_for_tile(tile, lock_key)
+            if data is not None:
+                return self.deliver_tile(tile.etag, data)
+            logger.debug('Waiting for tile failed, requesting it ourselves.')
+
+        try:
+            async with self.session.get(self.get_tile_url(tile), headers=self.auth_headers) as r:
+                content = await r.read()
+                response, cacheable = self.upstream_response(tile, r.status, r.reason,
+                                                             r.headers.get('Content-Type'), content)
+            if cacheable:
+                await self.cache_set(tile.cache_key, content)
+                if self.disk_cache is not None:
+                    await asyncio.get_event_loop().run_in_executor(None, self.disk_cache.set, tile.etag, content)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error('Upstream tile request failed: %r' % e)
+            return self.internal_server_error()
+        finally:
+            if locked:
+                await self.cache_delete(lock_key)
+        return response
+
+    async def wait_for_tile(self, tile, lock_key):
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.tile_lock_timeout
+        while loop.time() < deadline:
+            await asyncio.sleep(self.tile_lock_poll_interval)
+            data = await self.cache_get(tile.cache_key)
+            if data is not None:
+                return data
+            if await self.cache_get(lock_key) is None:
+                # the other process is done, but did not get a tile
+                return await self.cache_get(tile.cache_key)
+        return None
+
+
+application = AsyncTileServer()
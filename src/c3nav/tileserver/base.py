@@ -0,0 +1,200 @@
+import base64
+import hmac
+import json
+import logging
+import os
+import re
+import time
+from collections import namedtuple
+from email.utils import formatdate
+
+from c3nav.mapdata.utils.tiles import (build_access_cache_key, build_base_cache_key, build_tile_etag, get_tile_bounds,
+                                       parse_tile_access_cookie)
+from c3nav.tileserver.diskcache import DiskTileCache
+
+logger = logging.getLogger('c3nav')
+
+TileRequest = namedtuple('TileRequest', ('level', 'zoom', 'x', 'y', 'access_cache_key', 'etag', 'cache_key'))
+
+
+class BaseTileServer:
+    """
+    configuration and request handling shared by the wsgi and the asgi tile server.
+    responses are built as (status, headers, body) tuples.
+    """
+    def __init__(self):
+        self.path_regex = re.compile(r'^/(\d+)/(-?\d+)/(-?\d+)/(-?\d+).png$')
+
+        self.cookie_regex = re.compile(r'(^| )c3nav_tile_access="?([^;" ]+)"?')
+
+        try:
+            self.upstream_base = os.environ['C3NAV_UPSTREAM_BASE'].strip('/')
+        except KeyError:
+            raise Exception('C3NAV_UPSTREAM_BASE needs to be set.')
+
+        try:
+            self.data_dir = os.environ.get('C3NAV_DATA_DIR', 'data')
+        except KeyError:
+            raise Exception('C3NAV_DATA_DIR needs to be set.')
+
+        if not os.path.exists(self.data_dir):
+            os.mkdir(self.data_dir)
+
+        self.tile_secret = os.environ.get('C3NAV_TILE_SECRET', None)
+        if not self.tile_secret:
+            tile_secret_file = None
+            try:
+                tile_secret_file = os.environ['C3NAV_TILE_SECRET_FILE']
+                self.tile_secret = open(tile_secret_file).read().strip()
+            except KeyError:
+                raise Exception('C3NAV_TILE_SECRET or C3NAV_TILE_SECRET_FILE need to be set.')
+            except FileNotFoundError:
+                raise Exception('The C3NAV_TILE_SECRET_FILE (%s) does not exist.' % tile_secret_file)
+
+        self.reload_interval = int(os.environ.get('C3NAV_RELOAD_INTERVAL', 60))
+
+        # upstream connection pool
+        self.http_pool_size = int(os.environ.get('C3NAV_HTTP_POOL_SIZE', 10))
+        self.http_timeout = (float(os.environ.get('C3NAV_HTTP_CONNECT_TIMEOUT', 5)),
+                             float(os.environ.get('C3NAV_HTTP_READ_TIMEOUT', 60)))
+        self.http_retries = int(os.environ.get('C3NAV_HTTP_RETRIES', 2))
+        self.http_backoff_factor = float(os.environ.get('C3NAV_HTTP_BACKOFF_FACTOR', 0.2))
+
+        # optional disk cache tier behind memcached, size in megabytes
+        disk_cache_size = int(os.environ.get('C3NAV_TILE_DISK_CACHE_SIZE', 0))
+        self.disk_cache = None
+        if disk_cache_size:
+            self.disk_cache = DiskTileCache(os.path.join(self.data_dir, 'tiles'), disk_cache_size*1024*1024)
+
+        # while a tile is being rendered upstream, other processes wait for it instead of requesting it themselves
+        self.tile_lock_timeout = int(os.environ.get('C3NAV_TILE_LOCK_TIMEOUT', 30))
+        self.tile_lock_poll_interval = 0.05
+
+        self.auth_headers = {'X-Tile-Secret': base64.b64encode(self.tile_secret.encode()).decode()}
+
+        self.cache_package = None
+        self.cache_package_etag = None
+        self.cache_package_filename = None
+
+    @property
+    def cache_package_url(self):
+        # only the levels that changed since the last download are transferred
+        return self.upstream_base+'/map/cache/package.delta.tar'
+
+    @staticmethod
+    def get_cache_package_params(base):
+        # the level hashes of the package we will apply the delta to, nothing to get the full package
+        level_hashes = {} if base is None or base.level_hashes is None else base.level_hashes
+        return {'levels': ','.join('%d:%s' % item for item in sorted(level_hashes.items()))}
+
+    def get_tile_url(self, tile):
+        return '%s/map/%d/%d/%d/%d/%s.png' % (self.upstream_base, tile.level, tile.zoom, tile.x, tile.y,
+                                              tile.access_cache_key)
+
+    @staticmethod
+    def get_tile_lock_key(tile):
+        return tile.cache_key+'_lock'
+
+    def get_date_header(self):
+        return 'Date', formatdate(timeval=time.time(), localtime=False, usegmt=True)
+
+    def check_secret(self, secret):
+        # constant time comparison, so the secret can not be guessed by timing the responses
+        if secret is None:
+            return False
+        return hmac.compare_digest(secret.encode(), self.auth_headers['X-Tile-Secret'].encode())
+
+    def json_response(self, data):
+        text = json.dumps(data).encode()
+        return '200 OK', [self.get_date_header(),
+                          ('Content-Type', 'application/json'),
+                          ('Content-Length', str(len(text))),
+                          ('Cache-Control', 'no-cache')], text
+
+    def not_found(self, text):
+        return '404 Not Found', [self.get_date_header(),
+                                 ('Content-Type', 'text/plain'),
+                                 ('Content-Length', str(len(text)))], text
+
+    def internal_server_error(self, text=b'internal server error'):
+        return '500 Internal Server Error', [self.get_date_header(),
+                                             ('Content-Type', 'text/plain'),
+                                             ('Content-Length', str(len(text)))], text
+
+    def not_modified(self, etag):
+        return '304 Not Modified', [self.get_date_header(),
+                                    ('Content-Length', '0'),
+                                    ('ETag', etag)], b''
+
+    def deliver_tile(self, etag, data):
+        return '200 OK', [self.get_date_header(),
+                          ('Content-Type', 'image/png'),
+                          ('Content-Length', str(len(data))),
+                          ('Cache-Control', 'no-cache'),
+                          ('ETag', etag)], data
+
+    def upstream_response(self, tile, status_code, reason, content_type, content):
+        """
+        pass on the upstream response, or deliver the tile if the upstream rendered it
+        :return: response, whether the content is a tile that should be cached
+        """
+        if status_code == 200 and content_type == 'image/png':
+            return self.deliver_tile(tile.etag, content), True
+
+        return ('%d %s' % (status_code, reason), [
+            self.get_date_header(),
+            ('Content-Length', str(len(content))),
+            ('Content-Type', content_type or 'text/plain')
+        ], content), False
+
+    def get_tile_request(self, cache_package, path_info, cookie, if_none_match):
+        """
+        parse and check the tile request: path, bounds, level, access cookie and browser cache
+        :return: response to send right away or None, tile request or None
+        """
+        match = self.path_regex.match(path_info)
+        if match is None:
+            return self.not_found(b'invalid tile path.'), None
+
+        level, zoom, x, y = match.groups()
+
+        zoom = int(zoom)
+        if not (-2 <= zoom <= 5):
+            return self.not_found(b'zoom out of bounds.'), None
+
+        # check if bounds are valid
+        x = int(x)
+        y = int(y)
+        minx, miny, maxx, maxy = get_tile_bounds(zoom, x, y)
+        if not cache_package.bounds_valid(minx, miny, maxx, maxy):
+            return self.not_found(b'coordinates out of bounds.'), None
+
+        # get level
+        level = int(level)
+        level_data = cache_package.levels.get(level)
+        if level_data is None:
+            return self.not_found(b'invalid level.'), None
+
+        # build cache keys
+        last_update = level_data.history.last_update(minx, miny, maxx, maxy)
+        base_cache_key = build_base_cache_key(last_update)
+
+        # decode access permissions
+        access_permissions = set()
+        access_cache_key = '0'
+
+        if cookie:
+            cookie = self.cookie_regex.search(cookie)
+            if cookie:
+                cookie = cookie.group(2)
+                access_permissions = (parse_tile_access_cookie(cookie, self.tile_secret) &
+                                      set(level_data.restrictions[minx:maxx, miny:maxy]))
+                access_cache_key = build_access_cache_key(access_permissions)
+
+        # check browser cache
+        tile_etag = build_tile_etag(level, zoom, x, y, base_cache_key, access_cache_key, self.tile_secret)
+        if if_none_match == tile_etag:
+            return self.not_modified(tile_etag), None
+
+        return None, TileRequest(level=level, zoom=zoom, x=x, y=y, access_cache_key=access_cache_key,
+                                 etag=tile_etag, cache_key=path_info+'_'+tile_etag)
@@ -0,0 +1,114 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger('c3nav')
+
+
+class DiskTileCache:
+    """
+    size-bounded on-disk tile cache, content-addressed by tile etag.
+    files are written atomically, the least recently used ones are removed when the cache gets too big.
+    can be shared by multiple processes, every process keeps its own estimate of the total size.
+    """
+    tmp_max_age = 3600  # temporary files older than this were left behind by a crashed process
+
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+        self.size = None  # unknown until the first eviction run, which is started by the first write
+        self.evicting = False
+
+        if not os.path.exists(self.root):
+            os.makedirs(self.root, exist_ok=True)
+
+    def get_filename(self, etag):
+        digest = hashlib.sha1(etag.encode()).hexdigest()
+        return os.path.join(self.root, digest[:2], digest+'.png')
+
+    def open(self, etag):
+        """
+        :return: opened tile file or None
+        """
+        filename = self.get_filename(etag)
+        try:
+            f = open(filename, 'rb')
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(filename)  # mark as recently used
+        except OSError:
+            pass
+        return f
+
+    def get(self, etag):
+        f = self.open(etag)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def set(self, etag, data):
+        filename = self.get_filename(etag)
+        dirname = os.path.dirname(filename)
+        try:
+            os.makedirs(dirname, exist_ok=True)
+            fd, tmp_filename = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_filename, filename)
+        except OSError as e:
+            logger.warning('Writing tile to disk cache failed: %s' % e)
+            return
+
+        if self.size is not None:
+            self.size += len(data)
+        if (self.size is None or self.size > self.max_size) and not self.evicting:
+            self.evicting = True
+            threading.Thread(target=self.evict, daemon=True).start()
+
+    def evict(self):
+        """
+        recalculate the size of the cache and remove the least recently used files if it is too big.
+        temporary files are not counted, stale ones are removed.
+        """
+        try:
+            start = time.perf_counter()
+            tmp_deadline = time.time() - self.tmp_max_age
+            files = []
+            for dirpath, dirnames, filenames in os.walk(self.root):
+                for filename in filenames:
+                    filename = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.stat(filename)
+                    except FileNotFoundError:
+                        continue
+                    if filename.endswith('.tmp'):
+                        if stat.st_mtime < tmp_deadline:
+                            try:
+                                os.remove(filename)
+                            except FileNotFoundError:
+                                pass
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, filename))
+
+            size = sum(file[1] for file in files)
+            if size > self.max_size:
+                # evict down to 90% so this doesn't run for every new tile
+                target_size = self.max_size * 0.9
+                files.sort()
+                for mtime, file_size, filename in files:
+                    if size <= target_size:
+                        break
+                    try:
+                        os.remove(filename)
+                    except FileNotFoundError:
+                        pass
+                    size -= file_size
+                logger.info('Disk tile cache evicted to %d bytes in %.3f s.' % (size, time.perf_counter() - start))
+            self.size = size
+        finally:
+            self.evicting = False
@@ -0,0 +1,88 @@
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+
+class PoolStats:
+    """
+    connection pool statistics, to size the pool against the upstream server
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self.wait_time = 0
+        self.max_wait_time = 0
+
+    def add_request(self, wait_time):
+        with self.lock:
+            self.requests += 1
+            self.wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+
+    def add_connection(self):
+        with self.lock:
+            self.connections += 1
+
+    def serialize(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'connections': self.connections,
+                'reuse_ratio': round(1 - self.connections / self.requests, 4) if self.requests else None,
+                'wait_time': round(self.wait_time, 6),
+                'avg_wait_time': round(self.wait_time / self.requests, 6) if self.requests else None,
+                'max_wait_time': round(self.max_wait_time, 6),
+            }
+
+
+class PoolStatsMixin:
+    stats = None
+
+    def _get_conn(self, timeout=None):
+        start = time.perf_counter()
+        conn = super()._get_conn(timeout=timeout)
+        self.stats.add_request(time.perf_counter() - start)
+        return conn
+
+    def _new_conn(self):
+        self.stats.add_connection()
+        return super()._new_conn()
+
+
+class PoolStatsHTTPAdapter(HTTPAdapter):
+    """
+    http adapter that records connection pool statistics
+    """
+    def __init__(self, stats, **kwargs):
+        self.stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        attrs = {'stats': self.stats}
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': type('StatsHTTPConnectionPool', (PoolStatsMixin, HTTPConnectionPool), attrs),
+            'https': type('StatsHTTPSConnectionPool', (PoolStatsMixin, HTTPSConnectionPool), attrs),
+        }
+
+
+def build_session(stats, pool_size, retries, backoff_factor):
+    """
+    build a requests session with a bounded connection pool that retries failed requests with backoff.
+    only connection errors and 502/503/504 responses to idempotent requests are retried. read errors are not,
+    the upstream might still be rendering. if the retries are exhausted, the last response is returned.
+    """
+    session = requests.Session()
+    retry = Retry(total=retries, connect=retries, read=0, backoff_factor=backoff_factor,
+                  method_whitelist=frozenset(('GET', 'HEAD')), status_forcelist=(502, 503, 504),
+                  raise_on_status=False)
+    adapter = PoolStatsHTTPAdapter(stats, pool_connections=1, pool_maxsize=pool_size, pool_block=True,
+                                   max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
@@ -0,0 +1,61 @@
+import asyncio
+import threading
+
+
+class SingleFlightCall:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    in-process request coalescing for threads:
+    only the first caller for a key runs the function, concurrent callers for the same key wait for its result.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, func):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = SingleFlightCall()
+                self.calls[key] = call
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                self.calls.pop(key)
+            call.event.set()
+        return call.result
+
+
+class AsyncSingleFlight:
+    """
+    in-process request coalescing for coroutines, see SingleFlight.
+    the shared call is shielded, so it keeps running if the request that started it goes away.
+    """
+    def __init__(self):
+        self.calls = {}
+
+    async def do(self, key, func):
+        call = self.calls.get(key)
+        if call is None:
+            call = asyncio.ensure_future(func())
+            self.calls[key] = call
+            call.add_done_callback(lambda future: self.calls.pop(key))
+        return await asyncio.shield(call)
@@ -1,21 +1,19 @@
-import base64
 import logging
 import multiprocessing
 import os
-import pickle
 import re
 import threading
 import time
 from datetime import datetime
-from email.utils import formatdate
 from io import BytesIO
 
 import pylibmc
 import requests
 
-from c3nav.mapdata.utils.cache import CachePackage
-from c3nav.mapdata.utils.tiles import (build_access_cache_key, build_base_cache_key, build_tile_etag, get_tile_bounds,
-                                       parse_tile_access_cookie)
+from c3nav.mapdata.utils.cache import CachePackage, CachePackageBaseMismatch
+from c3nav.tileserver.base import BaseTileServer
+from c3nav.tileserver.http import PoolStats, build_session
+from c3nav.tileserver.singleflight import SingleFlight
 
 logging.basicConfig(level=logging.DEBUG if os.environ.get('C3NAV_DEBUG') else logging.INFO,
                     format='[%(asctime)s] [%(process)s] [%(levelname)s] %(name)s: %(message)s',
@@ -23,43 +21,15 @@ logging.basicConfig(level=logging.DEBUG if os.environ.get('C3NAV_DEBUG') else lo
 logger = logging.getLogger('c3nav')
 
 
-class TileServer:
+class TileServer(BaseTileServer):
     def __init__(self):
-        self.path_regex = re.compile(r'^/(\d+)/(-?\d+)/(-?\d+)/(-?\d+).png$')
+        super().__init__()
 
-        self.cookie_regex = re.compile(r'(^| )c3nav_tile_access="?([^;" ]+)"?')
+        self.single_flight = SingleFlight()
 
-        try:
-            self.upstream_base = os.environ['C3NAV_UPSTREAM_BASE'].strip('/')
-        except KeyError:
-            raise Exception('C3NAV_UPSTREAM_BASE needs to be set.')
-
-        try:
-            self.data_dir = os.environ.get('C3NAV_DATA_DIR', 'data')
-        except KeyError:
-            raise Exception('C3NAV_DATA_DIR needs to be set.')
-
-        if not os.path.exists(self.data_dir):
-            os.mkdir(self.data_dir)
-
-        self.tile_secret = os.environ.get('C3NAV_TILE_SECRET', None)
-        if not self.tile_secret:
-            tile_secret_file = None
-            try:
-                tile_secret_file = os.environ['C3NAV_TILE_SECRET_FILE']
-                self.tile_secret = open(tile_secret_file).read().strip()
-            except KeyError:
-                raise Exception('C3NAV_TILE_SECRET or C3NAV_TILE_SECRET_FILE need to be set.')
-            except FileNotFoundError:
-                raise Exception('The C3NAV_TILE_SECRET_FILE (%s) does not exist.' % tile_secret_file)
-
-        self.reload_interval = int(os.environ.get('C3NAV_RELOAD_INTERVAL', 60))
-
-        self.auth_headers = {'X-Tile-Secret': base64.b64encode(self.tile_secret.encode())}
-
-        self.cache_package = None
-        self.cache_package_etag = None
-        self.cache_package_filename = None
+        self.http_stats = PoolStats()
+        self.http_session = None
+        self.http_session_pid = None
 
         cache = self.get_cache_client()
 
@@ -75,6 +45,16 @@ class TileServer:
 
         threading.Thread(target=self.update_cache_package_thread, daemon=True).start()
 
+    @property
+    def http(self):
+        # one session per worker process, connection pools can't be shared between forked processes
+        if self.http_session_pid != os.getpid():
+            self.http_stats = PoolStats()
+            self.http_session = build_session(self.http_stats, pool_size=self.http_pool_size,
+                                              retries=self.http_retries, backoff_factor=self.http_backoff_factor)
+            self.http_session_pid = os.getpid()
+        return self.http_session
+
     @staticmethod
     def get_cache_client():
         return pylibmc.Client(["127.0.0.1"], binary=True, behaviors={"tcp_nodelay": True, "ketama": True})
@@ -85,76 +65,89 @@ class TileServer:
             time.sleep(self.reload_interval)
             self.load_cache_package(cache=cache)
 
-    def get_date_header(self):
-        return 'Date', formatdate(timeval=time.time(), localtime=False, usegmt=True)
-
     def load_cache_package(self, cache):
-        logger.debug('Downloading cache package from upstream...')
-        try:
-            headers = self.auth_headers.copy()
-            if self.cache_package_etag is not None:
-                headers['If-None-Match'] = self.cache_package_etag
-            r = requests.get(self.upstream_base+'/map/cache/package.tar.xz', headers=headers)
-
-            if r.status_code == 403:
-                logger.error('Rejected cache package download with Error 403. Tile secret is probably incorrect.')
-                return False
-
-            if r.status_code == 304:
-                if self.cache_package is not None:
-                    logger.debug('Not modified.')
-                    cache['cache_package_filename'] = self.cache_package_filename
-                    return True
-                logger.error('Unexpected not modified.')
+        # another worker might swap in a newer package any time, so only use this one
+        base = self.cache_package
+        while True:
+            logger.debug('Downloading cache package from upstream...')
+            try:
+                headers = self.auth_headers.copy()
+                if self.cache_package_etag is not None and base is not None:
+                    headers['If-None-Match'] = self.cache_package_etag
+                r = self.http.get(self.cache_package_url, params=self.get_cache_package_params(base),
+                                  headers=headers, timeout=self.http_timeout)
+
+                if r.status_code == 403:
+                    logger.error('Rejected cache package download with Error 403. Tile secret is probably incorrect.')
+                    return False
+
+                if r.status_code == 304:
+                    if self.cache_package is not None:
+                        logger.debug('Not modified.')
+                        cache['cache_package_filename'] = self.cache_package_filename
+                        return True
+                    logger.error('Unexpected not modified.')
+                    return False
+
+                r.raise_for_status()
+            except Exception as e:
+                logger.error('Cache package download failed: %s' % e)
                 return False
 
-            r.raise_for_status()
-        except Exception as e:
-            logger.error('Cache package download failed: %s' % e)
-            return False
+            logger.debug('Recieving and loading new cache package...')
 
-        logger.debug('Recieving and loading new cache package...')
-
-        try:
-            self.cache_package = CachePackage.read(BytesIO(r.content))
-            self.cache_package_etag = r.headers.get('ETag', None)
-        except Exception as e:
-            logger.error('Cache package parsing failed: %s' % e)
-            return False
+            try:
+                cache_package = CachePackage.read_delta(BytesIO(r.content), base=base)
+            except CachePackageBaseMismatch as e:
+                logger.warning('%s Downloading the full cache package.' % e)
+                base = None
+                continue
+            except Exception as e:
+                logger.error('Loading cache package failed: %s' % e)
+                return False
+            break
 
         try:
-            self.cache_package_filename = os.path.join(
+            # saved uncompressed, so every worker can memory map the same file
+            cache_package_filename = os.path.join(
                 self.data_dir,
-                datetime.now().strftime('%Y-%m-%d_%H-%M-%S-%f')+'.pickle'
+                datetime.now().strftime('%Y-%m-%d_%H-%M-%S-%f')+'.tar'
             )
-            with open(self.cache_package_filename, 'wb') as f:
-                pickle.dump(self.cache_package, f)
+            cache_package.save(cache_package_filename)
+            self.cache_package = CachePackage.open(cache_package_filename)
+            self.cache_package_filename = cache_package_filename
+            self.cache_package_etag = r.headers.get('ETag', None)
             cache.set('cache_package_filename', self.cache_package_filename)
         except Exception as e:
-            self.cache_package_etag = None
-            logger.error('Saving pickled package failed: %s' % e)
+            logger.error('Loading cache package failed: %s' % e)
             return False
+
+        self.remove_old_cache_packages(cache)
         return True
 
-    def not_found(self, start_response, text):
-        start_response('404 Not Found', [self.get_date_header(),
-                                         ('Content-Type', 'text/plain'),
-                                         ('Content-Length', str(len(text)))])
-        return [text]
-
-    def internal_server_error(self, start_response, text=b'internal server error'):
-        start_response('500 Internal Server Error', [self.get_date_header(),
-                                                     ('Content-Type', 'text/plain'),
-                                                     ('Content-Length', str(len(text)))])
-        return [text]
-
-    def deliver_tile(self, start_response, etag, data):
-        start_response('200 OK', [self.get_date_header(),
-                                  ('Content-Type', 'image/png'),
-                                  ('Content-Length', str(len(data))),
-                                  ('Cache-Control', 'no-cache'),
-                                  ('ETag', etag)])
-        return [data]
+    cache_package_filename_regex = re.compile(r'^\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}-\d{6}\.(tar|pickle)$')
+
+    def remove_old_cache_packages(self, cache):
+        # every worker might download and advertise its own package, so only the process whose package is the
+        # advertised one prunes. keep the advertised package, its predecessor (workers might not have switched yet)
+        # and newer ones that other workers are about to advertise.
+        # workers that still have an old one mapped can keep using it after it is deleted.
+        try:
+            advertised_filename = cache.get('cache_package_filename')
+        except pylibmc.Error as e:
+            logger.warning('pylibmc error in remove_old_cache_packages(): %s' % e)
+            return
+        if advertised_filename is None or advertised_filename != self.cache_package_filename:
+            return
+
+        advertised_filename = os.path.basename(advertised_filename)
+        filenames = sorted(filename for filename in os.listdir(self.data_dir)
+                           if self.cache_package_filename_regex.match(filename) and filename < advertised_filename)
+        for filename in filenames[:-1]:
+            try:
+                os.remove(os.path.join(self.data_dir, filename))
+            except OSError as e:
+                logger.warning('Removing old cache package failed: %s' % e)
 
     def get_cache_package(self):
         try:
@@ -168,9 +161,13 @@ class TileServer:
             return self.cache_package
         if self.cache_package_filename != cache_package_filename:
             logger.debug('Loading new cache package in worker.')
-            self.cache_package_filename = cache_package_filename
-            with open(self.cache_package_filename, 'rb') as f:
-                self.cache_package = pickle.load(f)
+            try:
+                cache_package = CachePackage.open(cache_package_filename)
+            except Exception as e:
+                # keep the current one, the filename stays different, so this is retried on the next request
+                logger.error('Loading cache package %s failed: %s' % (cache_package_filename, e))
+                return self.cache_package
+            self.cache_package, self.cache_package_filename = cache_package, cache_package_filename
         return self.cache_package
 
     cache_lock = multiprocessing.Lock()
@@ -182,81 +179,97 @@ class TileServer:
         return cache
 
     def __call__(self, env, start_response):
-        path_info = env['PATH_INFO']
-        match = self.path_regex.match(path_info)
-        if match is None:
-            return self.not_found(start_response, b'invalid tile path.')
+        status, headers, body = self.get_response(env)
+        start_response(status, headers)
+        return [body]
 
-        level, zoom, x, y = match.groups()
-
-        zoom = int(zoom)
-        if not (-2 <= zoom <= 5):
-            return self.not_found(start_response, b'zoom out of bounds.')
+    def get_response(self, env):
+        if env['PATH_INFO'] == '/stats':
+            if not self.check_secret(env.get('HTTP_X_TILE_SECRET')):
+                return self.not_found(b'invalid tile path.')
+            return self.json_response({'http_pool': self.http_stats.serialize()})
 
         # do this to be thread safe
         try:
             cache_package = self.get_cache_package()
         except Exception as e:
             logger.error('get_cache_package() failed: %s' % e)
-            return self.internal_server_error(start_response)
-
-        # check if bounds are valid
-        x = int(x)
-        y = int(y)
-        minx, miny, maxx, maxy = get_tile_bounds(zoom, x, y)
-        if not cache_package.bounds_valid(minx, miny, maxx, maxy):
-            return self.not_found(start_response, b'coordinates out of bounds.')
-
-        # get level
-        level = int(level)
-        level_data = cache_package.levels.get(level)
-        if level_data is None:
-            return self.not_found(start_response, b'invalid level.')
-
-        # build cache keys
-        last_update = level_data.history.last_update(minx, miny, maxx, maxy)
-        base_cache_key = build_base_cache_key(last_update)
-
-        # decode access permissions
-        access_permissions = set()
-        access_cache_key = '0'
-
-        cookie = env.get('HTTP_COOKIE', None)
-        if cookie:
-            cookie = self.cookie_regex.search(cookie)
-            if cookie:
-                cookie = cookie.group(2)
-                access_permissions = (parse_tile_access_cookie(cookie, self.tile_secret) &
-                                      set(level_data.restrictions[minx:maxx, miny:maxy]))
-                access_cache_key = build_access_cache_key(access_permissions)
-
-        # check browser cache
-        if_none_match = env.get('HTTP_IF_NONE_MATCH')
-        tile_etag = build_tile_etag(level, zoom, x, y, base_cache_key, access_cache_key, self.tile_secret)
-        if if_none_match == tile_etag:
-            start_response('304 Not Modified', [self.get_date_header(),
-                                                ('Content-Length', '0'),
-                                                ('ETag', tile_etag)])
-            return [b'']
-
-        cache_key = path_info+'_'+tile_etag
-        cached_result = self.cache.get(cache_key)
-        if cached_result is not None:
-            return self.deliver_tile(start_response, tile_etag, cached_result)
+            return self.internal_server_error()
 
-        r = requests.get('%s/map/%d/%d/%d/%d/%s.png' % (self.upstream_base, level, zoom, x, y, access_cache_key),
-                         headers=self.auth_headers)
+        response, tile = self.get_tile_request(cache_package, env['PATH_INFO'],
+                                               cookie=env.get('HTTP_COOKIE', None),
+                                               if_none_match=env.get('HTTP_IF_NONE_MATCH'))
+        if response is not None:
+            return response
 
-        if r.status_code == 200 and r.headers['Content-Type'] == 'image/png':
-            self.cache.set(cache_key, r.content)
-            return self.deliver_tile(start_response, tile_etag, r.content)
+        cached_result = self.cache.get(tile.cache_key)
+        if cached_result is not None:
+            return self.deliver_tile(tile.etag, cached_result)
+
+        if self.disk_cache is not None:
+            data = self.disk_cache.get(tile.etag)
+            if data is not None:
+                # put it back into memcached, so the next request does not have to read it from disk
+                try:
+                    self.cache.set(tile.cache_key, data)
+                except pylibmc.Error as e:
+                    logger.warning('pylibmc error in get_response(): %s' % e)
+                return self.deliver_tile(tile.etag, data)
+
+        return self.single_flight.do(tile.cache_key, lambda: self.fetch_tile(tile))
+
+    def fetch_tile(self, tile):
+        """
+        get the tile from upstream, unless another process is already doing that. then wait for its result.
+        """
+        cache = self.cache
+        lock_key = self.get_tile_lock_key(tile)
+        try:
+            locked = cache.add(lock_key, b'1', time=self.tile_lock_timeout)
+        except pylibmc.Error as e:
+            logger.warning('pylibmc error in fetch_tile(): %s' % e)
+            locked = True
 
-        start_response('%d %s' % (r.status_code, r.reason), [
-            self.get_date_header(),
-            ('Content-Length', len(r.content)),
-            ('Content-Type', r.headers.get('Content-Type', 'text/plain'))
-        ])
-        return [r.content]
+        if not locked:
+            data = self.wait_for_tile(cache, tile, lock_key)
+            if data is not None:
+                return self.deliver_tile(tile.etag, data)
+            logger.debug('Waiting for tile failed, requesting it ourselves.')
+
+        try:
+            r = self.http.get(self.get_tile_url(tile), headers=self.auth_headers, timeout=self.http_timeout)
+
+            response, cacheable = self.upstream_response(tile, r.status_code, r.reason,
+                                                         r.headers.get('Content-Type'), r.content)
+            if cacheable:
+                try:
+                    cache.set(tile.cache_key, r.content)
+                except pylibmc.Error as e:
+                    logger.warning('pylibmc error in fetch_tile(): %s' % e)
+                if self.disk_cache is not None:
+                    self.disk_cache.set(tile.etag, r.content)
+        except requests.RequestException as e:
+            logger.error('Upstream tile request failed: %r' % e)
+            return self.internal_server_error()
+        finally:
+            if locked:
+                try:
+                    cache.delete(lock_key)
+                except pylibmc.Error as e:
+                    logger.warning('pylibmc error in fetch_tile(): %s' % e)
+        return response
+
+    def wait_for_tile(self, cache, tile, lock_key):
+        deadline = time.time() + self.tile_lock_timeout
+        while time.time() < deadline:
+            time.sleep(self.tile_lock_poll_interval)
+            data = cache.get(tile.cache_key)
+            if data is not None:
+                return data
+            if cache.get(lock_key) is None:
+                # the other process is done, but did not get a tile
+                return cache.get(tile.cache_key)
+        return None
 
 
 application = TileServer()